@@ -19,7 +19,12 @@ class MembershipAdmin(admin.ModelAdmin):
     actions = ['approve_membership', 'disapprove_membership']
 
     def approve_membership(self, request, queryset):
-        rows_updated = queryset.update(approved=True)
+        # save one by one rather than queryset.update(), so the signals keep the social graph and the user cache in sync.
+        rows_updated = 0
+        for membership in queryset:
+            membership.approved = True
+            membership.save()
+            rows_updated += 1
         if rows_updated == 1:
             message_bit = "1 membership was"
         else:
@@ -27,7 +32,12 @@ class MembershipAdmin(admin.ModelAdmin):
         self.message_user(request, "%s successfully approved." % message_bit)
 
     def disapprove_membership(self, request, queryset):
-        rows_updated = queryset.update(approved=False)
+        # save one by one rather than queryset.update(), so the signals keep the social graph and the user cache in sync.
+        rows_updated = 0
+        for membership in queryset:
+            membership.approved = False
+            membership.save()
+            rows_updated += 1
         if rows_updated == 1:
             message_bit = "1 membership was"
         else:
@@ -0,0 +1,195 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from p2.utils import TrustLevel
+
+
+class UserEdges(object):
+    """
+    The outgoing edges of one user in the social graph, kept as sets of user ids.
+    This is everything UserConnection.trust_level() needs to answer for the user as the "initiate" user.
+    """
+
+    def __init__(self, user_id, version=None):
+        self.user_id = user_id
+        self.version = version      # the shared version token the edges were loaded at, see SocialGraph.get_version()
+        self.personal = {}          # active members of my personal circles => whether marked as admin (family)
+        self.approved_by = set()    # owners of the personal circles in which I'm an approved member
+        self.confirmed = set()      # users with a confirmed/successful contract with me, in either direction
+        self.extended = set()       # members in the personal circles of my active/approved personal members
+        self.public = set()         # members of the public circles I joined
+        self.loaded = time.time()
+
+    # keep the same order of checks as the original queries in UserConnection.trust_level()
+    def trust_level(self, target_id):
+        if target_id == self.user_id:
+            return TrustLevel.FULL.value
+        if target_id in self.personal:
+            return TrustLevel.CLOSE.value if self.personal[target_id] else TrustLevel.COMMON.value
+        if target_id in self.approved_by:
+            return TrustLevel.COMMON.value
+        if target_id in self.confirmed:
+            return TrustLevel.CLOSE.value
+        if target_id in self.extended or target_id in self.public:
+            return TrustLevel.REMOTE.value
+        return TrustLevel.NONE.value
+
+
+class SocialGraph(object):
+    """
+    In-memory index of personal-circle edges, public circle co-membership and confirmed-contract edges.
+    Edges of a user are loaded lazily with a fixed number of queries, and dropped when a Membership/Contract save touches the user.
+    Each process keeps its own index. Like p2.cache.UserCache, each user has a version token in the shared cache, and invalidating a user
+    replaces the token, so the edges cached in other processes are reloaded on their next use. Entries also expire after settings.SOCIAL_GRAPH_TTL
+    seconds as a backstop for writes that bypass the signals (e.g. raw SQL).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.edges = OrderedDict()
+
+    def get_version(self, user_id):
+        version_key = 'graph:version:%d' % user_id
+        version = cache.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.set(version_key, version, None)
+        return version
+
+    def get_edges(self, user_id):
+        # read the version before loading, so an invalidation that happens during the load is picked up next time.
+        version = self.get_version(user_id)
+        with self.lock:
+            edges = self.edges.get(user_id, None)
+            if edges is not None and edges.version == version and time.time() - edges.loaded < settings.SOCIAL_GRAPH_TTL:
+                self.edges.move_to_end(user_id)
+                return edges
+        edges = self.load_edges(user_id)
+        edges.version = version
+        with self.lock:
+            self.edges[user_id] = edges
+            while len(self.edges) > settings.SOCIAL_GRAPH_MAX_USERS:
+                self.edges.popitem(last=False)
+        return edges
+
+    def load_edges(self, user_id):
+        from circle.models import Circle, Membership
+        from contract.models import Contract
+
+        edges = UserEdges(user_id)
+        personal = Circle.Type.PERSONAL.value
+
+        for member_id, as_admin in Membership.objects.filter(circle__type=personal, circle__owner_id=user_id, active=True).values_list('member_id', 'as_admin'):
+            edges.personal[member_id] = edges.personal.get(member_id, False) or as_admin
+
+        edges.approved_by = set(Membership.objects.filter(circle__type=personal, member_id=user_id, approved=True).values_list('circle__owner_id', flat=True))
+
+        confirmed_status = (Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)
+        for client_id, server_id in Contract.objects.filter(status__in=confirmed_status).filter(Q(initiate_user_id=user_id) | Q(confirmed_match__target_user_id=user_id)).values_list('initiate_user_id', 'confirmed_match__target_user_id'):
+            edges.confirmed.add(server_id if client_id == user_id else client_id)
+
+        # friends' friends, and sitters in the extended network.
+        my_network = Membership.objects.filter(circle__type=personal, circle__owner_id=user_id, active=True, approved=True).values_list('member_id', flat=True)
+        edges.extended = set(Membership.objects.filter(circle__type=personal, circle__owner_id__in=my_network, active=True).exclude(approved=False).values_list('member_id', flat=True))
+
+        # co-members of the public circles I joined.
+        my_public_circles = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, member_id=user_id, active=True).exclude(approved=False).values_list('circle_id', flat=True)
+        edges.public = set(Membership.objects.filter(circle_id__in=my_public_circles, active=True).exclude(approved=False).values_list('member_id', flat=True))
+
+        return edges
+
+    def trust_level(self, initiate_user_id, target_user_id):
+        if initiate_user_id == target_user_id:
+            return TrustLevel.FULL.value
+        return self.get_edges(initiate_user_id).trust_level(target_user_id)
+
+    def trust_levels(self, initiate_user_id, target_user_ids):
+        edges = self.get_edges(initiate_user_id)
+        return {target_id: edges.trust_level(target_id) for target_id in target_user_ids}
+
+    def reverse_trust_levels(self, target_user_id, initiate_user_ids):
+        """
+        How much each of the "initiate" users trusts the one target user. Uses a fixed number of set-based queries
+        regardless of how many initiate users there are, and doesn't go through the index.
+        """
+        from circle.models import Circle, Membership
+        from contract.models import Contract
+
+        initiate_user_ids = set(initiate_user_ids)
+        personal = Circle.Type.PERSONAL.value
+        levels = {}
+        if target_user_id in initiate_user_ids:
+            levels[target_user_id] = TrustLevel.FULL.value
+
+        def assign(user_id, level):
+            if user_id in initiate_user_ids and user_id not in levels:
+                levels[user_id] = level
+
+        # the target user is in their personal circles.
+        in_personal = {}
+        for owner_id, as_admin in Membership.objects.filter(circle__type=personal, circle__owner_id__in=initiate_user_ids, member_id=target_user_id, active=True).values_list('circle__owner_id', 'as_admin'):
+            in_personal[owner_id] = in_personal.get(owner_id, False) or as_admin
+        for owner_id, as_admin in in_personal.items():
+            assign(owner_id, TrustLevel.CLOSE.value if as_admin else TrustLevel.COMMON.value)
+
+        # they are in the target user's personal circle and approved.
+        for member_id in Membership.objects.filter(circle__type=personal, circle__owner_id=target_user_id, member_id__in=initiate_user_ids, approved=True).values_list('member_id', flat=True):
+            assign(member_id, TrustLevel.COMMON.value)
+
+        confirmed_status = (Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)
+        for client_id, server_id in Contract.objects.filter(status__in=confirmed_status).filter(Q(initiate_user_id=target_user_id, confirmed_match__target_user_id__in=initiate_user_ids) | Q(initiate_user_id__in=initiate_user_ids, confirmed_match__target_user_id=target_user_id)).values_list('initiate_user_id', 'confirmed_match__target_user_id'):
+            assign(server_id if client_id == target_user_id else client_id, TrustLevel.CLOSE.value)
+
+        # the target user is in the personal circle of someone in their network.
+        target_in_circles_of = Membership.objects.filter(circle__type=personal, member_id=target_user_id, active=True).exclude(approved=False).values_list('circle__owner_id', flat=True)
+        for owner_id in Membership.objects.filter(circle__type=personal, circle__owner_id__in=initiate_user_ids, member_id__in=target_in_circles_of, active=True, approved=True).values_list('circle__owner_id', flat=True):
+            assign(owner_id, TrustLevel.REMOTE.value)
+
+        # they share a public circle with the target user.
+        target_public_circles = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, member_id=target_user_id, active=True).exclude(approved=False).values_list('circle_id', flat=True)
+        for member_id in Membership.objects.filter(circle_id__in=target_public_circles, member_id__in=initiate_user_ids, active=True).exclude(approved=False).values_list('member_id', flat=True):
+            assign(member_id, TrustLevel.REMOTE.value)
+
+        for user_id in initiate_user_ids:
+            assign(user_id, TrustLevel.NONE.value)
+        return levels
+
+    def invalidate(self, user_ids):
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        with self.lock:
+            for user_id in user_ids:
+                self.edges.pop(user_id, None)
+        cache.set_many({'graph:version:%d' % user_id: uuid.uuid4().hex for user_id in user_ids}, None)
+
+    def invalidate_membership(self, membership):
+        from circle.models import Membership
+        circle = membership.circle
+        if circle.is_type_personal():
+            # the owner's own edges, the member's "approved_by", and the extended network of whoever has the owner in their network.
+            affected = {circle.owner_id, membership.member_id}
+            affected.update(Membership.objects.filter(circle__type=circle.type, member_id=circle.owner_id, active=True, approved=True).values_list('circle__owner_id', flat=True))
+        else:
+            # everybody in the public circle sees the change in co-membership.
+            affected = set(Membership.objects.filter(circle_id=circle.id).values_list('member_id', flat=True))
+            affected.add(membership.member_id)
+        self.invalidate(affected)
+
+    def invalidate_contract(self, contract):
+        # the confirmed match might have been reverted, so drop every matched user, not just the confirmed one.
+        # this doesn't rely on the local index, which might not have the client's edges loaded.
+        affected = {contract.initiate_user_id}
+        affected.update(contract.match_set.values_list('target_user_id', flat=True))
+        self.invalidate(affected)
+
+    def clear(self):
+        with self.lock:
+            self.edges.clear()
+
+
+social_graph = SocialGraph()
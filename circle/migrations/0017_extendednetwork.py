@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('puser', '0003_info_private_note'),
+        ('circle', '0016_membership_strength'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtendedNetwork',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('as_role', models.PositiveSmallIntegerField(choices=[(7, 'Parent'), (8, 'Sitter')])),
+                ('shared_count', models.PositiveIntegerField(default=0)),
+                ('strength', models.FloatField(default=0.0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('area', models.ForeignKey(to='puser.Area')),
+                ('member', models.ForeignKey(to=settings.AUTH_USER_MODEL, related_name='+')),
+                ('owner', models.ForeignKey(to=settings.AUTH_USER_MODEL, related_name='extended_network')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='extendednetwork',
+            unique_together=set([('owner', 'area', 'member', 'as_role')]),
+        ),
+    ]
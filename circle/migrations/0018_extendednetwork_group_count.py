@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('circle', '0017_extendednetwork'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extendednetwork',
+            name='group_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='extendednetwork',
+            index_together=set([('owner', 'area', 'as_role')]),
+        ),
+    ]
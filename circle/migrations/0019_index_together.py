@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('circle', '0018_extendednetwork_group_count'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='circle',
+            index_together=set([('owner', 'type', 'area')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='membership',
+            index_together=set([('circle', 'active', 'approved', 'as_role'), ('member', 'active', 'approved')]),
+        ),
+    ]
@@ -6,8 +6,12 @@ from enum import Enum
 from account.models import SignupCode
 from django.core.urlresolvers import reverse
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from circle import tasks
+from p2.cache import user_cache
 from p2.utils import UserRole, TrustLevel, TrustedMixin, RelationshipType
 
 
@@ -62,6 +66,10 @@ class Circle(TrustedMixin, models.Model):
     area = models.ForeignKey('puser.Area')
     signup_code = models.OneToOneField('account.SignupCode', blank=True, null=True, on_delete=models.SET_NULL)
 
+    class Meta:
+        # personal circle lookup by owner (get_personal_circle, UserConnection, ExtendedNetwork).
+        index_together = [('owner', 'type', 'area')]
+
     def to_proxy(self):
         assert isinstance(self, Circle)
         if self.type == Circle.Type.PERSONAL.value and not isinstance(self, PersonalCircle):
@@ -460,6 +468,9 @@ class Membership(models.Model):
         # here we assume a user won't have multiple "membership" instances to the same circle.
         # relieving the assumption will affect many existing code
         unique_together = ('member', 'circle')
+        # circle members by role (recommender, discover), and a member's memberships (trust level, shared connections).
+        # the unique index above already covers (member, circle).
+        index_together = [('circle', 'active', 'approved', 'as_role'), ('member', 'active', 'approved')]
 
     # def is_type_normal(self):
     #     return self.type == Membership.Type.NORMAL.value
@@ -560,6 +571,127 @@ class Membership(models.Model):
         return RelationshipType.from_db(self.as_rel)
 
 
+class ExtendedNetwork(models.Model):
+    """
+    Precomputed 2-hop neighborhood (friends of friends, and members of the same public circles) of a user in an area.
+    Each row says "member" is in the personal circles of "shared_count" parents of "owner"'s network, and in "group_count" public circles
+    the owner joined, with the given role. Only members living in the area are included, and members already in the owner's personal circle are not.
+    Used by the recommender and the discover page. Rows are refreshed per owner with ExtendedNetwork.refresh().
+    """
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='extended_network')
+    member = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    area = models.ForeignKey('puser.Area')
+    as_role = models.PositiveSmallIntegerField(choices=[(t.value, t.name.capitalize()) for t in (UserRole.PARENT, UserRole.SITTER)])
+
+    # how many parents in the owner's network have the member in their personal circles.
+    shared_count = models.PositiveIntegerField(default=0)
+    # the sum of Membership.strength through those parents.
+    strength = models.FloatField(default=0.0)
+    # how many public circles the owner and the member are both in.
+    group_count = models.PositiveIntegerField(default=0)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('owner', 'area', 'member', 'as_role')
+        index_together = ('owner', 'area', 'as_role')
+
+    @staticmethod
+    def compute(owner_id, area_id):
+        """
+        Compute the rows of the owner in the area with two aggregate queries, without saving them. Returns a list of unsaved ExtendedNetwork.
+        """
+        personal = Circle.Type.PERSONAL.value
+        my_parents = Membership.objects.filter(circle__type=personal, circle__owner_id=owner_id, circle__area_id=area_id, active=True, approved=True, as_role=UserRole.PARENT.value).values_list('member_id', flat=True)
+        my_network = Membership.objects.filter(circle__type=personal, circle__owner_id=owner_id, circle__area_id=area_id, active=True).values_list('member_id', flat=True)
+        my_public_circles = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, circle__area_id=area_id, member_id=owner_id, active=True).exclude(approved=False).values_list('circle_id', flat=True)
+        candidates = Membership.objects.filter(active=True, approved=True, member__info__area_id=area_id).exclude(member_id=owner_id).exclude(member_id__in=my_network)
+
+        rows = {}
+        for row in candidates.filter(circle__type=personal, circle__area_id=area_id, circle__owner_id__in=my_parents).values('member_id', 'as_role').annotate(shared_count=models.Count('circle__owner_id', distinct=True), strength=models.Sum('strength')):
+            rows[(row['member_id'], row['as_role'])] = ExtendedNetwork(owner_id=owner_id, area_id=area_id, member_id=row['member_id'], as_role=row['as_role'], shared_count=row['shared_count'], strength=row['strength'] or 0.0)
+        for row in candidates.filter(circle_id__in=my_public_circles).values('member_id', 'as_role').annotate(group_count=models.Count('circle_id', distinct=True)):
+            en = rows.get((row['member_id'], row['as_role']), None)
+            if en is None:
+                en = rows[(row['member_id'], row['as_role'])] = ExtendedNetwork(owner_id=owner_id, area_id=area_id, member_id=row['member_id'], as_role=row['as_role'])
+            en.group_count = row['group_count']
+        return list(rows.values())
+
+    @staticmethod
+    def refresh(owner_id, area_id):
+        """
+        Recompute all rows of the owner in the area.
+        """
+        rows = ExtendedNetwork.compute(owner_id, area_id)
+        with transaction.atomic():
+            ExtendedNetwork.objects.filter(owner_id=owner_id, area_id=area_id).delete()
+            ExtendedNetwork.objects.bulk_create(rows)
+
+    @staticmethod
+    def refresh_member(owner_ids, member_id, area_id):
+        """
+        Recompute only the rows about one member for many owners, with a fixed number of queries regardless of how many owners there are.
+        Same rules as compute(), seen from the member's side.
+        """
+        personal = Circle.Type.PERSONAL.value
+        owner_ids = set(owner_ids) - {member_id}
+        rows = {}
+        from puser.models import Info
+        if owner_ids and Info.objects.filter(user_id=member_id, area_id=area_id).exists():
+            # owners who have the member in their own network don't get rows about the member.
+            in_network = set(Membership.objects.filter(circle__type=personal, circle__owner_id__in=owner_ids, circle__area_id=area_id, member_id=member_id, active=True).values_list('circle__owner_id', flat=True))
+            owner_ids -= in_network
+
+            # the parents who have the member in their personal circles, and the owners who have those parents in their network.
+            parent_memberships = list(Membership.objects.filter(circle__type=personal, circle__area_id=area_id, member_id=member_id, active=True, approved=True).values_list('circle__owner_id', 'as_role', 'strength'))
+            parents_of = defaultdict(set)
+            for owner_id, parent_id in Membership.objects.filter(circle__type=personal, circle__owner_id__in=owner_ids, circle__area_id=area_id, member_id__in={p for p, r, st in parent_memberships}, active=True, approved=True, as_role=UserRole.PARENT.value).values_list('circle__owner_id', 'member_id'):
+                parents_of[owner_id].add(parent_id)
+            for owner_id, parent_ids in parents_of.items():
+                for parent_id, as_role, strength in parent_memberships:
+                    if parent_id in parent_ids:
+                        en = rows.get((owner_id, as_role), None)
+                        if en is None:
+                            en = rows[(owner_id, as_role)] = ExtendedNetwork(owner_id=owner_id, area_id=area_id, member_id=member_id, as_role=as_role, shared_count=0, strength=0.0)
+                        en.shared_count += 1
+                        en.strength += strength or 0.0
+
+            # the public circles in the area both the owner and the member are in.
+            circle_roles = defaultdict(set)
+            for circle_id, as_role in Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, circle__area_id=area_id, member_id=member_id, active=True, approved=True).values_list('circle_id', 'as_role'):
+                circle_roles[circle_id].add(as_role)
+            group_count = defaultdict(int)
+            for owner_id, circle_id in Membership.objects.filter(circle_id__in=circle_roles.keys(), member_id__in=owner_ids, active=True).exclude(approved=False).values_list('member_id', 'circle_id'):
+                for as_role in circle_roles[circle_id]:
+                    group_count[(owner_id, as_role)] += 1
+            for (owner_id, as_role), count in group_count.items():
+                en = rows.get((owner_id, as_role), None)
+                if en is None:
+                    en = rows[(owner_id, as_role)] = ExtendedNetwork(owner_id=owner_id, area_id=area_id, member_id=member_id, as_role=as_role)
+                en.group_count = count
+
+        with transaction.atomic():
+            ExtendedNetwork.objects.filter(owner_id__in=owner_ids, area_id=area_id, member_id=member_id).delete()
+            ExtendedNetwork.objects.bulk_create(rows.values())
+
+    @staticmethod
+    def affected_by(membership):
+        """
+        Return (owner_ids, member_owner_ids) for a membership change: the owners whose whole extended network needs refresh(), and the owners
+        for whom only the rows about the member change, which refresh_member() handles.
+        For a personal circle, the circle owner's network changes, and those who have the circle owner as a parent see a different member.
+        For a public circle, the member's own network changes, and the other people in the circle see a different member.
+        """
+        circle = membership.circle
+        if circle.is_type_public():
+            member_owner_ids = set(Membership.objects.filter(circle=circle, active=True).exclude(member_id=membership.member_id).values_list('member_id', flat=True))
+            return {membership.member_id}, member_owner_ids
+        member_owner_ids = set(Membership.objects.filter(circle__type=Circle.Type.PERSONAL.value, circle__area_id=circle.area_id, member_id=circle.owner_id, active=True, approved=True, as_role=UserRole.PARENT.value).values_list('circle__owner_id', flat=True))
+        member_owner_ids.discard(circle.owner_id)
+        return {circle.owner_id}, member_owner_ids
+
+
 class UserConnection(object):
     """
     This is about how two users are connected. Similar things are in Match. Might need to combine in the future.
@@ -610,52 +742,28 @@ class UserConnection(object):
 
     # note: trust level is asymmetric
     # this is whether and how much the "initiate" user trust the "target" user.
+    # levels (checked in this order):
+    # CLOSE/COMMON: someone in my personal circles, CLOSE if marked as admin (family).
+    # COMMON: someone whose personal circle I'm part of and approved.
+    # CLOSE: anyone who has a confirmed match with me regardless of time.
+    # REMOTE: friend's friends, sitters in extended network, and members of the public circles I'm in.
+    # the answer comes from the in-memory social graph index. see circle.graph.
     def trust_level(self):
-        # Trust one's self is FULL
-        if self.initiate_user == self.target_user:
-            return TrustLevel.FULL.value
-
-        # level is COMMON: someone in my personal circles, regardless of whether they are parents or babysitters.
-        my_personal_circles = Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner=self.initiate_user)
-        target_memberships = Membership.objects.filter(circle__in=my_personal_circles, member=self.target_user, active=True)
-        if target_memberships.filter(as_admin=True).exists():
-            return TrustLevel.CLOSE.value
-        elif target_memberships.exists():
-            return TrustLevel.COMMON.value
-
-        # COMMON: someone i'm part of her personal circle which I approved
-        their_personal_circles = Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner=self.target_user)
-        if Membership.objects.filter(circle__in=their_personal_circles, member=self.initiate_user, approved=True).exists():
-            return TrustLevel.COMMON.value
-
-        from contract.models import Match, Contract
-
-        # COMMON: anyone who has a "match" object within +/1 7days window
-        # window_start = timezone.now() - timedelta(days=7)
-        # window_end = timezone.now() + timedelta(days=7)
-        # if Match.objects.filter(target_user=self.initiate_user, contract__initiate_user=self.target_user, contract__event_end__lt=window_end, contract__event_start__gt=window_start).exists():
-        #     return TrustLevel.COMMON.value
-        # if Match.objects.filter(target_user=self.target_user, contract__initiate_user=self.initiate_user, contract__event_end__lt=window_end, contract__event_start__gt=window_start).exists():
-        #     return TrustLevel.COMMON.value
-
-        # CLOSE: trust anyone who have a confirmed match regardless of time
-        if Contract.objects.filter(initiate_user=self.initiate_user, confirmed_match__target_user=self.target_user, status__in=(Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)).exists():
-            return TrustLevel.CLOSE.value
-        if Contract.objects.filter(initiate_user=self.target_user, confirmed_match__target_user=self.initiate_user, status__in=(Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)).exists():
-            return TrustLevel.CLOSE.value
-
-        # REMOTE: friend's friends, sitters in extended network.
-        personal_circle_membership = self.initiate_user.personal_circle_membership_queryset().filter(active=True, approved=True).values_list('member__id', flat=True)
-        my_network_circles = Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner__id__in=personal_circle_membership)
-        if Membership.objects.filter(circle__in=my_network_circles, active=True, member=self.target_user).exclude(approved=False).exists():
-            return TrustLevel.REMOTE.value
-
-        # REMOTE: trust someone in the public/TAG circles where I'm a member of.
-        my_public_circles = Circle.objects.filter(type=Circle.Type.PUBLIC.value, membership__member=self.initiate_user, membership__active=True).exclude(membership__approved=False)
-        if Membership.objects.filter(circle__in=my_public_circles, member=self.target_user, active=True).exclude(approved=False).exists():
-            return TrustLevel.REMOTE.value
-
-        return TrustLevel.NONE.value
+        from circle.graph import social_graph
+        return social_graph.trust_level(self.initiate_user.id, self.target_user.id)
+
+    @staticmethod
+    def trust_levels_bulk(user, candidate_ids, reverse=False):
+        """
+        Trust levels for many candidates at once, returned as {candidate_id: level}.
+        By default this is how much "user" trusts each candidate. With reverse=True, this is how much each candidate trusts "user",
+        i.e., UserConnection(candidate, user).trust_level(), which is computed with a fixed number of set-based queries.
+        """
+        from circle.graph import social_graph
+        if reverse:
+            return social_graph.reverse_trust_levels(user.id, candidate_ids)
+        else:
+            return social_graph.trust_levels(user.id, candidate_ids)
 
     # could raise DoesNotExist or multiple find.
     def find_personal_membership(self, area=None):
@@ -666,10 +774,9 @@ class UserConnection(object):
     # shared connection: in my parents friends' network
     def find_shared_connection_personal(self):
         # find all the parents in my network, regardless of area
-        my_parent_membership = Membership.objects.filter(circle__owner=self.initiate_user, circle__type=Circle.Type.PERSONAL.value, active=True, as_role=UserRole.PARENT.value).exclude(approved=False)
-        my_parent_list = set([m.member for m in my_parent_membership])
+        my_parent_list = Membership.objects.filter(circle__owner=self.initiate_user, circle__type=Circle.Type.PERSONAL.value, active=True, as_role=UserRole.PARENT.value).exclude(approved=False).values_list('member_id', flat=True)
         # find membership of the target_user in those parents' network. we don't use "as_role" here, which results in both parents and sitters.
-        result_membership = Membership.objects.filter(member=self.target_user, circle__owner__in=my_parent_list, circle__type=Circle.Type.PERSONAL.value, active=True).exclude(approved=False)
+        result_membership = Membership.objects.filter(member=self.target_user, circle__owner_id__in=my_parent_list, circle__type=Circle.Type.PERSONAL.value, active=True).exclude(approved=False).select_related('circle__owner')
         return list(result_membership)
 
     # compared to "find_shared_connection_personal", this only works for parents-parent, not for parents-sitter
@@ -684,22 +791,45 @@ class UserConnection(object):
     # shared connection: both you and i are in the save public circle.
     def find_shared_connection_public(self):
         # my public circle membership
-        my_public_membership = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, member=self.initiate_user, active=True).exclude(approved=False)
-        my_public_circles = set([m.circle for m in my_public_membership])
+        my_public_circles = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, member=self.initiate_user, active=True).exclude(approved=False).values_list('circle_id', flat=True)
         # find membership from target user in those public circles
-        result_membership = Membership.objects.filter(member=self.target_user, circle__in=my_public_circles, active=True).exclude(approved=False)
+        result_membership = Membership.objects.filter(member=self.target_user, circle_id__in=my_public_circles, active=True).exclude(approved=False)
         return list(result_membership)
 
+    # the direct membership (see find_personal_membership()), then find_shared_connection_personal() and find_shared_connection_public().
     def find_shared_connection_all(self):
-        connection_list = []
-        try:
-            direct = self.find_personal_membership()
-            connection_list.append(direct)
-        except (Membership.DoesNotExist, Membership.MultipleObjectsReturned) as e:
-            pass
-        connection_list.extend(self.find_shared_connection_personal())
-        connection_list.extend(self.find_shared_connection_public())
-        return connection_list
+        return UserConnection.find_shared_connection_bulk(self.initiate_user, [self.target_user.id])[self.target_user.id]
+
+    @staticmethod
+    def find_shared_connection_bulk(user, target_ids):
+        """
+        Same as find_shared_connection_all() from "user" to each of the targets, returned as {target_id: [membership]}.
+        This is one query: my parents and my public circles go in as subqueries.
+        """
+        target_ids = set(target_ids)
+        personal = Circle.Type.PERSONAL.value
+        area = user.to_puser().get_area()
+        my_parents = Membership.objects.filter(circle__owner=user, circle__type=personal, active=True, as_role=UserRole.PARENT.value).exclude(approved=False).values_list('member_id', flat=True)
+        my_public_circles = Membership.objects.filter(circle__type=Circle.Type.PUBLIC.value, member=user, active=True).exclude(approved=False).values_list('circle_id', flat=True)
+
+        q_direct = models.Q(circle__type=personal, circle__owner=user, circle__area=area)
+        q_personal = models.Q(circle__type=personal, circle__owner_id__in=my_parents, active=True) & ~models.Q(approved=False)
+        q_public = models.Q(circle_id__in=my_public_circles, active=True) & ~models.Q(approved=False)
+
+        direct, shared_personal, shared_public = defaultdict(list), defaultdict(list), defaultdict(list)
+        for m in Membership.objects.filter(member_id__in=target_ids).filter(q_direct | q_personal | q_public).select_related('circle').order_by('id'):
+            if m.circle.type != personal:
+                shared_public[m.member_id].append(m)
+            elif m.circle.owner_id == user.id:
+                direct[m.member_id].append(m)
+            else:
+                shared_personal[m.member_id].append(m)
+
+        result = {}
+        for target_id in target_ids:
+            # skip the direct membership if there are multiple, same as find_personal_membership().
+            result[target_id] = (direct[target_id] if len(direct[target_id]) == 1 else []) + shared_personal[target_id] + shared_public[target_id]
+        return result
 
     def count_served(self):
         from puser.models import PUser
@@ -842,4 +972,39 @@ class Friendship(UserConnection):
                 self.reverse_membership = Membership.objects.create(circle=other_circle, member=self.initiate_user, as_role=UserRole.PARENT.value, active=False, approved=True)
                 self.add_membership(self.reverse_membership)
         # simply activate a membership does not automatically get approved (which is required for "established")
-        # assert self.is_established()
\ No newline at end of file
+        # assert self.is_established()
+
+
+############################ signals ###############################
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_update_social_graph(sender, **kwargs):
+    from circle.graph import social_graph
+    social_graph.invalidate_membership(kwargs['instance'])
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_refresh_extended_network(sender, **kwargs):
+    instance = kwargs['instance']
+    if instance.circle.is_type_personal() or instance.circle.is_type_public():
+        owner_ids, member_owner_ids = ExtendedNetwork.affected_by(instance)
+        tasks.refresh_extended_network.delay(list(owner_ids), instance.circle.area_id, instance.member_id, list(member_owner_ids))
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_invalidate_user_cache(sender, **kwargs):
+    instance = kwargs['instance']
+    user_cache.invalidate([instance.member_id, instance.circle.owner_id])
+
+
+# circle proxies send signals with their own class as sender.
+@receiver(post_save, sender=Circle)
+@receiver(post_save, sender=PersonalCircle)
+@receiver(post_save, sender=PublicCircle)
+@receiver(post_delete, sender=Circle)
+def circle_invalidate_user_cache(sender, **kwargs):
+    user_cache.invalidate([kwargs['instance'].owner_id])
@@ -6,6 +6,16 @@ def dummy(x, y):
     return x + y
 
 
+@shared_task
+def refresh_extended_network(owner_ids, area_id, member_id=None, member_owner_ids=()):
+    from circle.models import ExtendedNetwork
+    for owner_id in owner_ids:
+        ExtendedNetwork.refresh(owner_id, area_id)
+    # the other affected owners only need their rows about the one member.
+    if member_id is not None:
+        ExtendedNetwork.refresh_member(set(member_owner_ids) - set(owner_ids), member_id, area_id)
+
+
 # from puser.models import PUser
 #
 #
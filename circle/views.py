@@ -1,4 +1,5 @@
 import random
+from collections import defaultdict
 from itertools import groupby
 import json
 import re
@@ -7,13 +8,14 @@ from braces.views import LoginRequiredMixin, FormValidMessageMixin, UserPassesTe
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 
+from django.db.models import F, Q
 from django.forms import HiddenInput
 from django.shortcuts import redirect
 from django.views.defaults import permission_denied
 from django.views.generic import FormView, CreateView, UpdateView, TemplateView, DetailView, View
 from django.views.generic.detail import SingleObjectMixin
 from circle.forms import CircleCreateForm, MembershipCreateForm, MembershipEditForm, ParentAddForm, SitterAddForm
-from circle.models import Membership, Circle, UserConnection, Friendship
+from circle.models import Membership, Circle, UserConnection, Friendship, ExtendedNetwork
 from circle.tasks import circle_invite
 from puser.models import PUser
 from p2.utils import RegisteredRequiredMixin, UserRole, is_valid_email, ObjectAccessMixin, TrustLevel
@@ -87,7 +89,8 @@ class PersonalCircleView(CircleView):
 
         # my network
         list_membership = my_personal_circle.membership_set.filter(active=True).exclude(approved=False).exclude(member=me).order_by('-updated')
-        list_membership = self.add_extra_filter(list_membership)
+        list_membership = self.add_extra_filter(list_membership).select_related('member__info')
+        PUser.preload_profiles([m.member for m in list_membership])
         context['list_membership'] = list_membership
 
         # my extended network
@@ -96,9 +99,10 @@ class PersonalCircleView(CircleView):
         # need to sort by member in order to use groupby.
         extended = []
         list_extended = Membership.objects.filter(active=True, circle__in=extended_circle_list).exclude(member=me).exclude(approved=False).exclude(member__id__in=list_membership.values_list('member__id', flat=True)).order_by('member', '-updated')
-        list_extended = self.add_extra_filter(list_extended)
+        list_extended = self.add_extra_filter(list_extended).select_related('member__info')
         for member, membership_list in groupby(list_extended, lambda m: m.member):
             extended.append(UserConnection(me, member, list(membership_list)))
+        PUser.preload_profiles([uc.target_user for uc in extended])
         context['list_extended'] = extended
 
         context['full_access'] = True
@@ -610,37 +614,33 @@ class DiscoverView(LoginRequiredMixin, RegisteredRequiredMixin, DetailView):
 
     # the logic here is:
     # 1. find my friends (network)
-    # 2. find my friends' friends who are not in my network
+    # 2. find my friends' friends who are not in my network, and people in my public circles
     # 3. if those people haven't disapproved me, then show them.
+    # 1 and 2 are precomputed in ExtendedNetwork. here we take the best connected candidates and check the trust levels in one batch.
     def get_extended(self, as_role):
         me = self.object
         area = me.get_area()
-        my_personal_circle = me.get_personal_circle(area=area)
-        # my network (use to filter existing users)
-        existing_membership = my_personal_circle.membership_set.filter(active=True).exclude(member=me)
-
-        # my extended network
-        my_parent_list = [m.member for m in my_personal_circle.membership_set.filter(active=True, as_role=UserRole.PARENT.value).exclude(approved=False).exclude(member=me)]
-        extended_circle_list = Circle.objects.filter(owner__in=my_parent_list, type=my_personal_circle.type, area=my_personal_circle.area).values_list('id', flat=True)
-
-        # my public network
-        public_circle_list = me.membership_set.filter(circle__type=Circle.Type.PUBLIC.value, active=True, circle__area=me.get_area()).exclude(approved=False).values_list('circle__id', flat=True)
-
-        combined_circle_list = list(extended_circle_list) + list(public_circle_list)
-
-        # need to sort by member in order to use groupby.
-        list_extended = Membership.objects.filter(active=True, approved=True, circle__id__in=combined_circle_list, as_role=as_role, member__info__area=area).exclude(member=me).exclude(member__id__in=existing_membership.values_list('member__id', flat=True)).order_by('member', '-updated')
-
-        # build
-        extended = []
-        for member, membership_list in groupby(list_extended, lambda m: m.member):
-            # if trust level is too low, then don't add.
-            member_to_me = UserConnection(member, me)
-            if member_to_me.trusted(TrustLevel.REMOTE):
-                extended.append(UserConnection(me, member, list(membership_list)))
-        extended.sort(key=lambda x: len(x.membership_list), reverse=True)
-
-        return extended
+        display_max = self.display_limit * 2
+        candidate_ids = list(ExtendedNetwork.objects.filter(owner=me, area=area, as_role=as_role).annotate(connections=F('shared_count') + F('group_count')).order_by('-connections', '-strength', 'member_id').values_list('member_id', flat=True)[:display_max * 2])
+        if not candidate_ids and not ExtendedNetwork.objects.filter(owner=me, area=area).exists():
+            # not computed yet (e.g. before "manage.py rebuild_extended_network" ran): use the live query.
+            rows = sorted((en for en in ExtendedNetwork.compute(me.id, area.id) if en.as_role == as_role), key=lambda en: (-(en.shared_count + en.group_count), -en.strength, en.member_id))
+            candidate_ids = [en.member_id for en in rows][:display_max * 2]
+
+        # how much each member trusts me, in one batch.
+        trust_levels = UserConnection.trust_levels_bulk(me, candidate_ids, reverse=True)
+        # if trust level is too low, then don't add.
+        member_ids = [member_id for member_id in candidate_ids if trust_levels[member_id] >= TrustLevel.REMOTE.value][:display_max]
+
+        # the memberships that connect me to those members, for display.
+        my_parent_list = Membership.objects.filter(circle__owner=me, circle__type=Circle.Type.PERSONAL.value, circle__area=area, active=True, as_role=UserRole.PARENT.value).exclude(approved=False).exclude(member=me).values_list('member_id', flat=True)
+        public_circle_list = me.membership_set.filter(circle__type=Circle.Type.PUBLIC.value, active=True, circle__area=area).exclude(approved=False).values_list('circle_id', flat=True)
+        membership_list = defaultdict(list)
+        for membership in Membership.objects.filter(Q(circle__type=Circle.Type.PERSONAL.value, circle__area=area, circle__owner_id__in=my_parent_list) | Q(circle_id__in=public_circle_list), member_id__in=member_ids, active=True, approved=True, as_role=as_role).select_related('circle__owner').order_by('-updated'):
+            membership_list[membership.member_id].append(membership)
+
+        members = PUser.objects.with_profile().in_bulk(member_ids)
+        return [UserConnection(me, members[member_id], membership_list[member_id]) for member_id in member_ids]
 
     def get_extended_sitter(self):
         return self.get_extended(UserRole.SITTER.value)
@@ -660,12 +660,10 @@ class DiscoverView(LoginRequiredMixin, RegisteredRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         def process_list(t):
-            mt = t[:display_max]
-            random.shuffle(mt)
-            return mt[:self.display_limit]
+            random.shuffle(t)
+            return t[:self.display_limit]
 
         context = super().get_context_data(**kwargs)
-        display_max = self.display_limit * 2
         context.update({
             'circle': self.object.get_personal_circle(),
             'list_extended_sitter': process_list(self.get_extended_sitter()),
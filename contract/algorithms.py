@@ -2,7 +2,10 @@ from functools import wraps
 import json
 from abc import ABCMeta
 
-from circle.models import Membership
+from django.conf import settings
+from django.db.models import Count
+
+from circle.models import Membership, ExtendedNetwork
 from p2.utils import UserRole
 from puser.models import PUser
 
@@ -35,13 +38,7 @@ class RecommenderStrategy(metaclass=ABCMeta):
         if not isinstance(self.data, dict) or 'users' not in self.data or not isinstance(self.data['users'], list) or len(self.data['users']) < 1:
             return
         request_user_list = PUser.objects.filter(id__in=self.data['users'])
-        if not request_user_list.exists():
-            return
-        matched_user_list = self.contract.get_matched_users()
-
-        to_add_list = set(request_user_list) - set(matched_user_list)
-        for target_user in to_add_list:
-            self.contract.add_match_by_user(target_user)
+        self.contract.add_matches_bulk(request_user_list)
 
     # similar to add_match_from_data, but the users are from the circle.
     # todo: make more intelligent match based on previous interactions, etc.
@@ -52,8 +49,29 @@ class RecommenderStrategy(metaclass=ABCMeta):
             qs = qs.filter(as_role=as_role)
         if limit > 0:
             qs = qs[:limit]
-        for membership in qs:
-            self.contract.add_match_by_user(membership.member)
+        self.contract.add_matches_bulk([membership.member for membership in qs.select_related('member')])
+
+    # add users from the client's precomputed friends-of-friends network (see circle.models.ExtendedNetwork).
+    # candidates are ranked by shared connections, membership strength and how many jobs they have served before.
+    def add_match_from_extended_network(self, limit=10, as_role=None):
+        from contract.models import Contract
+        contract = self.contract
+        matched_user_list = contract.get_matched_users()
+        # only friends of friends; members who only share a public circle are for the discover page.
+        qs = ExtendedNetwork.objects.filter(owner=contract.initiate_user, area=contract.area, shared_count__gt=0).exclude(member__in=matched_user_list)
+        if as_role is not None:
+            qs = qs.filter(as_role=as_role)
+        candidates = list(qs.values_list('member_id', 'shared_count', 'strength'))
+        if not candidates:
+            return
+
+        # one aggregate query for the served count of all candidates.
+        served = dict(Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value, confirmed_match__target_user_id__in=[c[0] for c in candidates]).values_list('confirmed_match__target_user_id').annotate(c=Count('id')))
+        scored = sorted(((shared_count + strength + served.get(member_id, 0), member_id) for member_id, shared_count, strength in candidates), reverse=True)
+        if limit > 0:
+            scored = scored[:limit]
+        users = PUser.objects.in_bulk([member_id for score, member_id in scored])
+        contract.add_matches_bulk([users[member_id] for score, member_id in scored], scores={member_id: score for score, member_id in scored})
 
     def is_contract_recommendable(self):
         contract = self.contract
@@ -74,6 +92,24 @@ class SmartRecommender(RecommenderStrategy):
 
         # todo: make recommendations on other (esp. for paid jobs, babysitters from friends of friends)
 
+    def recommend_initial(self):
+        # only the top few from my personal network. recommend() runs later in the background.
+        contract = self.contract
+        self.add_match_from_data()
+        personal_circle = contract.initiate_user.to_puser().get_personal_circle()
+        as_role = UserRole.PARENT.value if contract.is_favor() else UserRole.SITTER.value
+        self.add_match_from_circle(personal_circle, limit=settings.CONTRACT_INITIAL_MATCHES, as_role=as_role)
+
+
+class ExtendedNetworkRecommender(SmartRecommender):
+    """
+    Besides SmartRecommender, also recommends sitters from friends' personal circles for paid jobs.
+    """
+    def recommend(self):
+        super(ExtendedNetworkRecommender, self).recommend()
+        if not self.contract.is_favor():
+            self.add_match_from_extended_network(limit=10, as_role=UserRole.SITTER.value)
+
 
 class ManualRecommender(RecommenderStrategy):
     def recommend(self):
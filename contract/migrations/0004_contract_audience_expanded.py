@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0003_match_memberships'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contract',
+            name='audience_expanded',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
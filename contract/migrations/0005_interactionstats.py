@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+# Contract.Status.SUCCESSFUL at the time of this migration.
+SUCCESSFUL = 4
+
+
+def backfill_interaction_stats(apps, schema_editor):
+    Contract = apps.get_model('contract', 'Contract')
+    InteractionStats = apps.get_model('contract', 'InteractionStats')
+    # count successful contracts by (server, client). for a reversed contract, the initiate user is the server.
+    rows = {}
+    favor = models.Sum(models.Case(models.When(price__lte=0, then=models.Value(1)), default=models.Value(0), output_field=models.IntegerField()))
+    qs = Contract.objects.filter(status=SUCCESSFUL, confirmed_match__isnull=False)
+    for is_reversed, server_field, client_field in ((False, 'confirmed_match__target_user_id', 'initiate_user_id'), (True, 'initiate_user_id', 'confirmed_match__target_user_id')):
+        for server_id, client_id, served, favors in qs.filter(reversed=is_reversed).values_list(server_field, client_field).annotate(served=models.Count('id'), favors=favor):
+            old_served, old_favors = rows.get((server_id, client_id), (0, 0))
+            rows[(server_id, client_id)] = (old_served + served, old_favors + favors)
+    InteractionStats.objects.bulk_create([InteractionStats(server_id=server_id, client_id=client_id, served=served, favors=favors) for (server_id, client_id), (served, favors) in rows.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contract', '0004_contract_audience_expanded'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InteractionStats',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('served', models.IntegerField(default=0)),
+                ('favors', models.IntegerField(default=0)),
+                ('client', models.ForeignKey(to=settings.AUTH_USER_MODEL, related_name='+')),
+                ('server', models.ForeignKey(to=settings.AUTH_USER_MODEL, related_name='+')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='interactionstats',
+            unique_together=set([('server', 'client')]),
+        ),
+        migrations.RunPython(backfill_interaction_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0005_interactionstats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='contract',
+            index_together=set([('event_start', 'event_end')]),
+        ),
+    ]
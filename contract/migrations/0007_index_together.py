@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0006_contract_event_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='contract',
+            index_together=set([('event_start', 'event_end'), ('status', 'event_start'), ('status', 'event_end'), ('initiate_user', 'status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='match',
+            index_together=set([('contract', 'status'), ('target_user', 'status')]),
+        ),
+    ]
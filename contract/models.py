@@ -6,13 +6,14 @@ from decimal import Decimal
 from django.utils import timezone
 from django.utils import dateformat
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.dispatch import receiver, Signal
 from django.conf import settings
 from circle.models import UserConnection
 
 from contract import tasks
+from p2.cache import user_cache
 from p2.utils import TrustedMixin, TrustLevel
 
 
@@ -24,8 +25,14 @@ class StatusMixin(object):
     # IMPORTANT: all status change should go through this for centralized trigger handling.
     def change_status(self, old_status, new_status):
         assert self.status == old_status, 'Status does not match: %s, %s' % (self.__class__.Status(old_status), self.__class__.Status(new_status))
-        self.status = new_status
-        self.save()
+        with transaction.atomic():
+            self.status = new_status
+            self.save()
+            self.status_changed(old_status, new_status)
+
+    # override to update other data in the same transaction as the status change.
+    def status_changed(self, old_status, new_status):
+        pass
 
     # instead of polymorphism using the Contract/Match class, we want centralized handle here to make things read clear.
     def display_status(self):
@@ -136,6 +143,14 @@ class Contract(StatusMixin, TrustedMixin, models.Model):
     # where does this contract happens. this is the ultimate place to decide where a contract goes
     area = models.ForeignKey('puser.Area')
 
+    # when the background stage of activation (full recommendation) finished. null if not yet.
+    audience_expanded = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        # for calendar range queries: event_start <= range end and event_end >= range start.
+        # (status, event_start/event_end) for the status commands and reminders, (initiate_user, status) for the headline.
+        index_together = [('event_start', 'event_end'), ('status', 'event_start'), ('status', 'event_end'), ('initiate_user', 'status')]
+
     def __str__(self):
         return 'Contract:%d:%s' % (self.id, self.initiate_user.username)
 
@@ -157,10 +172,22 @@ class Contract(StatusMixin, TrustedMixin, models.Model):
         new_status = Contract.Status.ACTIVE.value
         self.change_status(old_status, new_status)
 
-        # todo: non-blocking process
-        # tasks.after_contract_activated.delay(self)
-        # make it blocking to make sure there are some matches.
-        tasks.after_contract_activated(self)
+        # fast stage: only the top few matches from the indexes, so that there are some matches right away.
+        self.recommend(initial=True)
+        # slow stage: expand the audience and send notifications.
+        tasks.after_contract_activated.delay(self)
+
+    def activation_progress(self):
+        """
+        Match counts by status, to poll the activation pipeline. Notifications are still being sent while "pending" > 0.
+        """
+        counts = dict(self.match_set.values_list('status').annotate(c=models.Count('id')))
+        return {
+            'status': Contract.Status(self.status).name.lower(),
+            'matches': {s.name.lower(): counts.get(s.value, 0) for s in Match.Status},
+            'pending': counts.get(Match.Status.INITIALIZED.value, 0),
+            'done': self.audience_expanded is not None and counts.get(Match.Status.INITIALIZED.value, 0) == 0,
+        }
 
     def confirm(self, match):
         assert self.confirmed_match is None, 'Confirmed match already exists.'
@@ -198,6 +225,42 @@ class Contract(StatusMixin, TrustedMixin, models.Model):
         self.change_status(Contract.Status.CONFIRMED.value, Contract.Status.ACTIVE.value)
         tasks.after_contract_reverted.delay(self, old_confirmed_match)
 
+    def status_changed(self, old_status, new_status):
+        # keep InteractionStats in sync with the successful contracts.
+        successful = Contract.Status.SUCCESSFUL.value
+        if new_status == successful and old_status != successful:
+            InteractionStats.record(self, 1)
+        elif old_status == successful and new_status != successful:
+            InteractionStats.record(self, -1)
+
+    @staticmethod
+    def bulk_change_status(qs, old_status, new_status, batch_size=500):
+        """
+        Set-based change_status() for the contracts in qs with old_status, one UPDATE per id-range batch in its own short transaction.
+        Only rows still in old_status are changed, so it's idempotent and a rerun picks up where an interrupted run stopped.
+        Instead of post_save, "contract_status_batch_changed" is sent once per batch in the same transaction. Returns the number of changed rows.
+        """
+        total, last_id = 0, 0
+        while True:
+            candidate_ids = list(qs.filter(status=old_status, id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not candidate_ids:
+                return total
+            last_id = candidate_ids[-1]
+            with transaction.atomic():
+                # lock only the rows in the batch, and skip the ones changed by somebody else in the meantime.
+                contract_ids = list(Contract.objects.select_for_update().filter(id__in=candidate_ids, status=old_status).values_list('id', flat=True))
+                Contract.objects.filter(id__in=contract_ids).update(status=new_status, updated=timezone.now())
+                contract_status_batch_changed.send(sender=Contract, contract_ids=contract_ids, old_status=old_status, new_status=new_status)
+            total += len(contract_ids)
+
+    # (server, client) user ids of a confirmed contract. for a reversed contract, the initiate user is the server.
+    def get_server_client_ids(self):
+        assert self.confirmed_match is not None
+        if self.reversed:
+            return self.initiate_user_id, self.confirmed_match.target_user_id
+        else:
+            return self.confirmed_match.target_user_id, self.initiate_user_id
+
     def is_active(self):
         return self.status == Contract.Status.ACTIVE.value
 
@@ -337,11 +400,39 @@ class Contract(StatusMixin, TrustedMixin, models.Model):
         match.save()
         return match
 
+    # bulk version of add_match_by_user() with a fixed number of queries. users already matched are skipped.
+    # the post_save signal doesn't fire with bulk_create, so all new matches are engaged in one task instead.
+    def add_matches_bulk(self, users, scores=None):
+        matched_ids = set(self.match_set.values_list('target_user_id', flat=True))
+        target_ids = []
+        for user in users:
+            if user.id not in matched_ids and user.id != self.initiate_user_id:
+                matched_ids.add(user.id)
+                target_ids.append(user.id)
+        if not target_ids:
+            return []
+        scores = scores or {}
+        connections = UserConnection.find_shared_connection_bulk(self.initiate_user, target_ids)
+
+        with transaction.atomic():
+            Match.objects.bulk_create([Match(contract=self, target_user_id=target_id, status=Match.Status.INITIALIZED.value, score=scores.get(target_id, 1)) for target_id in target_ids])
+            # bulk_create doesn't set the primary keys on every backend, so read them back.
+            match_list = list(Match.objects.filter(contract=self, target_user_id__in=target_ids))
+            through = Match.memberships.through
+            through_list = []
+            for match in match_list:
+                for membership_id in set(m.id for m in connections[match.target_user_id]):
+                    through_list.append(through(match_id=match.id, membership_id=membership_id))
+            through.objects.bulk_create(through_list)
+
+        tasks.engage_initialized_matches.delay([match.id for match in match_list])
+        return match_list
+
     def recommend(self, initial=False):
         # factory method
         from contract import algorithms
         if self.audience_type == Contract.AudienceType.SMART.value:
-            recommender = algorithms.SmartRecommender(self)
+            recommender = algorithms.ExtendedNetworkRecommender(self)
         elif self.audience_type == Contract.AudienceType.MANUAL.value:
             recommender = algorithms.ManualRecommender(self)
         else:
@@ -404,6 +495,8 @@ class Match(StatusMixin, models.Model):
 
     class Meta:
         unique_together = ('contract', 'target_user')
+        # the unique index covers (contract, target_user). these are for filtering by status.
+        index_together = [('contract', 'status'), ('target_user', 'status')]
 
     def get_absolute_url(self):
         return reverse('contract:match_view', kwargs={'pk': self.pk})
@@ -437,7 +530,7 @@ class Match(StatusMixin, models.Model):
     def is_responded(self):
         return self.is_accepted() or self.is_declined()
 
-    def engage(self):
+    def engage(self, delay=True):
         """
         shout to the targeted user and engage him/her for this match.
         """
@@ -446,8 +539,11 @@ class Match(StatusMixin, models.Model):
             new_status = Match.Status.ENGAGED.value
             self.change_status(old_status, new_status)
 
-            # non-blocking process
-            tasks.after_match_engaged.delay(self)
+            # non-blocking process, unless we are already in a task.
+            if delay:
+                tasks.after_match_engaged.delay(self)
+            else:
+                tasks.after_match_engaged(self)
 
     def count_served(self):
         from puser.models import PUser
@@ -475,9 +571,7 @@ class Match(StatusMixin, models.Model):
         """
         Positive number; client owes server favors; negative number: server owes client favor.
         """
-        favors = self.count_favors()
-        favors_reverse = self.count_favors_reverse()
-        return favors - favors_reverse
+        return InteractionStats.favors_karma(self.target_user_id, self.contract.initiate_user_id)
 
     def to_engagement(self):
         return Engagement.from_match(self)
@@ -486,6 +580,89 @@ class Match(StatusMixin, models.Model):
         return UserConnection(self.contract.initiate_user, self.target_user, list(self.memberships.all()))
 
 
+class InteractionStats(models.Model):
+    """
+    How many times "server" has served "client" with successful contracts, and how many of them are favors.
+    Updated in Contract.status_changed(); rebuild from history with "manage.py rebuild_interaction_stats".
+    """
+    server = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    client = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    served = models.IntegerField(default=0)
+    favors = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('server', 'client')
+
+    def __str__(self):
+        return 'InteractionStats:%d-%d' % (self.server_id, self.client_id)
+
+    @staticmethod
+    def record(contract, delta):
+        if contract.confirmed_match is None:
+            return
+        server_id, client_id = contract.get_server_client_ids()
+        stats, created = InteractionStats.objects.get_or_create(server_id=server_id, client_id=client_id)
+        InteractionStats.objects.filter(pk=stats.pk).update(served=models.F('served') + delta, favors=models.F('favors') + (delta if contract.is_favor() else 0))
+        from puser.models import Info
+        Info.objects.filter(user_id=server_id).update(favor_count=models.F('favor_count') + delta)
+
+    @staticmethod
+    def record_bulk(contract_ids, delta):
+        """
+        record() for many contracts at once, with a few queries per (server, client) pair instead of per contract.
+        """
+        from puser.models import Info
+        rows = InteractionStats.aggregate_history(contract_ids)
+        for (server_id, client_id), (served, favors) in rows.items():
+            stats, created = InteractionStats.objects.get_or_create(server_id=server_id, client_id=client_id)
+            InteractionStats.objects.filter(pk=stats.pk).update(served=models.F('served') + served * delta, favors=models.F('favors') + favors * delta)
+            Info.objects.filter(user_id=server_id).update(favor_count=models.F('favor_count') + served * delta)
+
+    @staticmethod
+    def lookup(server_id, client_id):
+        """
+        Returns (served, favors) of server to client.
+        """
+        stats = InteractionStats.objects.filter(server_id=server_id, client_id=client_id).values_list('served', 'favors').first()
+        return stats if stats else (0, 0)
+
+    @staticmethod
+    def favors_karma(server_id, client_id):
+        favors = dict(InteractionStats.objects.filter(models.Q(server_id=server_id, client_id=client_id) | models.Q(server_id=client_id, client_id=server_id)).values_list('server_id', 'favors'))
+        return favors.get(server_id, 0) - favors.get(client_id, 0)
+
+    @staticmethod
+    def rebuild():
+        rows = InteractionStats.aggregate_history()
+        totals = {}
+        for (server_id, client_id), (served, favors) in rows.items():
+            totals[server_id] = totals.get(server_id, 0) + served
+        from puser.models import Info
+        with transaction.atomic():
+            InteractionStats.objects.all().delete()
+            InteractionStats.objects.bulk_create([InteractionStats(server_id=server_id, client_id=client_id, served=served, favors=favors) for (server_id, client_id), (served, favors) in rows.items()])
+            Info.objects.exclude(favor_count=0).update(favor_count=0)
+            for server_id, total in totals.items():
+                Info.objects.filter(user_id=server_id).update(favor_count=total)
+
+    @staticmethod
+    def aggregate_history(contract_ids=None):
+        """
+        Count successful contracts by (server, client), or the contracts in contract_ids regardless of their status.
+        """
+        rows = {}
+        favor = models.Sum(models.Case(models.When(price__lte=0, then=models.Value(1)), default=models.Value(0), output_field=models.IntegerField()))
+        if contract_ids is None:
+            qs = Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value, confirmed_match__isnull=False)
+        else:
+            qs = Contract.objects.filter(id__in=contract_ids, confirmed_match__isnull=False)
+        for is_reversed, server_field, client_field in ((False, 'confirmed_match__target_user_id', 'initiate_user_id'), (True, 'initiate_user_id', 'confirmed_match__target_user_id')):
+            for server_id, client_id, served, favors in qs.filter(reversed=is_reversed).values_list(server_field, client_field).annotate(served=models.Count('id'), favors=favor):
+                old_served, old_favors = rows.get((server_id, client_id), (0, 0))
+                rows[(server_id, client_id)] = (old_served + served, old_favors + favors)
+        return rows
+
+
 class Engagement(object):
     """
     This is a single match or a contract without a match. Shown at the homepage.
@@ -585,6 +762,10 @@ class Engagement(object):
 # see also http://stackoverflow.com/questions/2719038/where-should-signal-handlers-live-in-a-django-project
 
 
+# sent by Contract.bulk_change_status() once per batch, in place of post_save of each contract.
+contract_status_batch_changed = Signal(providing_args=['contract_ids', 'old_status', 'new_status'])
+
+
 # this automatically activates the contract.
 # todo: add payment step.
 @receiver(post_save, sender=Contract)
@@ -612,3 +793,42 @@ def match_auto_engage(sender, **kwargs):
     # only do it when the match was first created.
     if created and instance.status == Match.Status.INITIALIZED.value:
         instance.engage()
+
+
+@receiver(post_save, sender=Contract)
+def contract_update_social_graph(sender, **kwargs):
+    from circle.graph import social_graph
+    social_graph.invalidate_contract(kwargs['instance'])
+
+
+@receiver(post_save, sender=Contract)
+def contract_invalidate_user_cache(sender, **kwargs):
+    instance = kwargs['instance']
+    user_ids = set(instance.match_set.values_list('target_user_id', flat=True))
+    user_ids.add(instance.initiate_user_id)
+    user_cache.invalidate(user_ids)
+
+
+@receiver(post_save, sender=Match)
+def match_invalidate_user_cache(sender, **kwargs):
+    instance = kwargs['instance']
+    user_cache.invalidate([instance.target_user_id, instance.contract.initiate_user_id])
+
+
+@receiver(contract_status_batch_changed, sender=Contract)
+def contract_batch_record_interaction_stats(sender, contract_ids, old_status, new_status, **kwargs):
+    # same as Contract.status_changed() for the batch.
+    successful = Contract.Status.SUCCESSFUL.value
+    if new_status == successful and old_status != successful:
+        InteractionStats.record_bulk(contract_ids, 1)
+    elif old_status == successful and new_status != successful:
+        InteractionStats.record_bulk(contract_ids, -1)
+
+
+@receiver(contract_status_batch_changed, sender=Contract)
+def contract_batch_invalidate(sender, contract_ids, **kwargs):
+    from circle.graph import social_graph
+    user_ids = set(Contract.objects.filter(id__in=contract_ids).values_list('initiate_user_id', flat=True))
+    user_ids.update(Match.objects.filter(contract_id__in=contract_ids).values_list('target_user_id', flat=True))
+    social_graph.invalidate(user_ids)
+    user_cache.invalidate(user_ids)
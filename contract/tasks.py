@@ -19,11 +19,10 @@ def after_contract_created(contract):
 
 @shared_task
 def after_contract_activated(contract):
-    # compute matches
-    # from contract.algorithms import L1Recommender
-    # recommender = L1Recommender()
-    # recommender.recommend(contract)
-    contract.recommend(initial=True)
+    # the initial matches were created in Contract.activate(). now do the full recommendation.
+    contract.recommend()
+    contract.audience_expanded = now()
+    contract.save(update_fields=['audience_expanded'])
 
     from shout.notify import notify_agent
     from puser.models import PUser
@@ -46,13 +45,14 @@ def after_contract_confirmed(contract):
     notify_agent.send(confirmed_match.target_user, contract.initiate_user, 'contract/messages/contract_confirmed_review',
                       {'match': confirmed_match, 'contract': contract, 'initiate_user': initiate_user, 'target_user': target_user})
     # finally, shout to other people accepted/not responded.
-    for match in contract.match_set.filter(status__in=(Match.Status.ENGAGED.value, Match.Status.ACCEPTED.value)).exclude(pk=confirmed_match.pk):
-        if match.is_accepted():
-            notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_confirmed_to_accepted',
-                          {'match': match, 'contract': contract, 'initiate_user': initiate_user, 'target_user': match.target_user})
-        else:
-            notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_confirmed_to_engaged',
-                          {'match': match, 'contract': contract, 'initiate_user': initiate_user, 'target_user': match.target_user})
+    with notify_agent.batch():
+        for match in contract.match_set.filter(status__in=(Match.Status.ENGAGED.value, Match.Status.ACCEPTED.value)).exclude(pk=confirmed_match.pk).select_related('target_user'):
+            if match.is_accepted():
+                notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_confirmed_to_accepted',
+                                  {'match': match, 'contract': contract, 'initiate_user': initiate_user, 'target_user': match.target_user})
+            else:
+                notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_confirmed_to_engaged',
+                                  {'match': match, 'contract': contract, 'initiate_user': initiate_user, 'target_user': match.target_user})
     # schedule reminder tasks
     # fixme: if contract is confirmed and then undo and then confirmed again. we want to make sure it doesn't have problems
     before_contract_starts.apply_async((contract,), eta=contract.event_start - timedelta(hours=1))
@@ -132,6 +132,24 @@ def after_match_engaged(match):
         notify_agent.send(match.contract.initiate_user, match.target_user, 'contract/messages/match_engaged_reversed', context)
 
 
+@shared_task
+def engage_initialized_matches(match_ids):
+    # engage the matches added by one Contract.add_matches_bulk() call in one task. each match is claimed with a conditional
+    # update, so a match engaged elsewhere in the meantime doesn't get its server notified twice.
+    from contract.models import Match
+    from p2.cache import user_cache
+    from shout.notify import notify_agent
+    initialized, engaged = Match.Status.INITIALIZED.value, Match.Status.ENGAGED.value
+    with notify_agent.batch():
+        for match in Match.objects.filter(pk__in=match_ids, status=initialized).select_related('contract__initiate_user', 'target_user'):
+            if Match.objects.filter(pk=match.pk, status=initialized).update(status=engaged) != 1:
+                continue
+            match.status = engaged
+            # the update doesn't send post_save, see contract.models.match_invalidate_user_cache.
+            user_cache.invalidate([match.target_user_id, match.contract.initiate_user_id])
+            after_match_engaged(match)
+
+
 @shared_task
 def after_contract_reverted(contract, match):
     from shout.notify import notify_agent
@@ -171,9 +189,9 @@ def after_contract_updated(contract):
     # send all "accepted" and not responded servers the updated info notes.
     from shout.notify import notify_agent
     from contract.models import Match
-    for match in contract.match_set.filter(status__in=(Match.Status.ACCEPTED.value, Match.Status.ENGAGED.value)):
-        notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_updated',
-                          {'contract': contract, 'match': match})
+    match_list = contract.match_set.filter(status__in=(Match.Status.ACCEPTED.value, Match.Status.ENGAGED.value)).select_related('target_user')
+    notify_agent.send_each(contract.initiate_user, 'contract/messages/contract_updated',
+                           [(match.target_user, {'contract': contract, 'match': match}) for match in match_list])
 
 
 @shared_task
@@ -181,6 +199,6 @@ def after_contract_canceled(contract):
     if not contract.is_event_expired():
         from shout.notify import notify_agent
         from contract.models import Match
-        for match in contract.match_set.filter(status=Match.Status.ACCEPTED.value):
-            notify_agent.send(contract.initiate_user, match.target_user, 'contract/messages/contract_canceled',
-                              {'contract': contract, 'match': match})
+        match_list = contract.match_set.filter(status=Match.Status.ACCEPTED.value).select_related('target_user')
+        notify_agent.send_each(contract.initiate_user, 'contract/messages/contract_canceled',
+                               [(match.target_user, {'contract': contract, 'match': match}) for match in match_list])
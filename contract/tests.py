@@ -1,9 +1,16 @@
-from datetime import datetime
+import json
+from datetime import datetime, timedelta
 
+from django.core import mail
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
-from contract.models import Contract
+from circle.models import UserConnection
+from contract import tasks
+from contract.models import Contract, InteractionStats, Match
+from p2.cache import user_cache
 from p2.utils import TestEnvMixin
 from puser.models import PUser
 
@@ -14,3 +21,115 @@ class ContractTest(TestEnvMixin, TestCase):
         u = PUser.get_by_email('test@servuno.com')
         contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)))
         self.assertEqual(20, contract.hourly_rate())
+
+    def test_add_matches_bulk(self):
+        u = PUser.get_by_email('test@servuno.com')
+        targets = [PUser.get_by_email('test%s@servuno.com' % s) for s in ('1', '2', '3')]
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)))
+        contract.match_set.all().delete()
+        contract.add_matches_bulk(targets + [u])
+        self.assertEqual({t.id for t in targets}, set(contract.match_set.values_list('target_user_id', flat=True)))
+        for match in contract.match_set.all():
+            uc = UserConnection(u, match.target_user)
+            self.assertEqual({m.id for m in uc.find_shared_connection_all()}, set(match.memberships.values_list('id', flat=True)))
+        # already matched users are skipped.
+        self.assertEqual([], contract.add_matches_bulk(targets))
+
+    def test_engage_initialized_matches(self):
+        u = PUser.get_by_email('test@servuno.com')
+        targets = [PUser.get_by_email('test%s@servuno.com' % s) for s in ('1', '2', '3')]
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)))
+        contract.match_set.all().delete()
+        match_ids = [match.id for match in contract.add_matches_bulk(targets)]
+        mail.outbox = []
+        # a second task for the same matches doesn't notify the servers again.
+        tasks.engage_initialized_matches(match_ids)
+        tasks.engage_initialized_matches(match_ids)
+        self.assertEqual(len(match_ids), len(mail.outbox))
+        self.assertEqual({Match.Status.ENGAGED.value}, set(Match.objects.filter(pk__in=match_ids).values_list('status', flat=True)))
+
+    def test_interaction_stats(self):
+        u = PUser.get_by_email('test@servuno.com')
+        u1 = PUser.get_by_email('test1@servuno.com')
+        # created as active, so contract_auto_activate doesn't recommend other users.
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=0, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)), status=Contract.Status.ACTIVE.value)
+        self.assertFalse(contract.match_set.exists())
+        match, = contract.add_matches_bulk([u1])
+        contract.confirm(match)
+        contract.succeed()
+        self.assertEqual((1, 1), InteractionStats.lookup(u1.id, u.id))
+        self.assertEqual(1, u1.count_favors(u))
+        self.assertEqual(1, u1.count_interactions(u))
+        self.assertEqual(1, match.count_favors_karma())
+        self.assertEqual(1, PUser.get_by_email('test1@servuno.com').get_level()['count'])
+        self.assertEqual({u1.id: PUser.get_by_email('test1@servuno.com').get_level(), u.id: PUser.get_by_email('test@servuno.com').get_level()}, PUser.levels_for([u1.id, u.id]))
+        user_cache.invalidate([u1.id, u.id])
+        with self.assertNumQueries(1):
+            self.assertEqual(1, PUser.levels_for([u1.id, u.id])[u1.id]['count'])
+        expected = set(InteractionStats.objects.values_list('server_id', 'client_id', 'served', 'favors'))
+        InteractionStats.rebuild()
+        self.assertEqual(expected, set(InteractionStats.objects.values_list('server_id', 'client_id', 'served', 'favors')))
+
+    def test_bulk_change_status(self):
+        u = PUser.get_by_email('test@servuno.com')
+        u1 = PUser.get_by_email('test1@servuno.com')
+        # created as active, so contract_auto_activate doesn't recommend other users.
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=0, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)), status=Contract.Status.ACTIVE.value)
+        self.assertFalse(contract.match_set.exists())
+        match, = contract.add_matches_bulk([u1])
+        contract.confirm(match)
+        qs = Contract.objects.filter(event_end__lt=timezone.now() - timedelta(days=7))
+        self.assertEqual(1, Contract.bulk_change_status(qs, Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value, batch_size=1))
+        self.assertEqual(Contract.Status.SUCCESSFUL.value, Contract.objects.get(pk=contract.pk).status)
+        self.assertEqual((1, 1), InteractionStats.lookup(u1.id, u.id))
+        # rerun doesn't change anything.
+        self.assertEqual(0, Contract.bulk_change_status(qs, Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value))
+        self.assertEqual((1, 1), InteractionStats.lookup(u1.id, u.id))
+
+    def test_update_expired_contract_lock(self):
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from p2.management.commands.update_expired_contract import Command
+        u = PUser.get_by_email('test@servuno.com')
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=0, event_start=make_aware(datetime(2015, 1, 1, 13, 0, 0)), event_end=make_aware(datetime(2015, 1, 1, 14, 30, 0)))
+        # contract_auto_activate has already activated the new contract.
+        self.assertEqual(Contract.Status.ACTIVE.value, contract.status)
+        # another run holds the lock: skip, and leave its lock alone.
+        cache.set(Command.lock_key, 'other', Command.lock_timeout)
+        call_command('update_expired_contract')
+        self.assertEqual(Contract.Status.ACTIVE.value, Contract.objects.get(pk=contract.pk).status)
+        self.assertEqual('other', cache.get(Command.lock_key))
+        cache.delete(Command.lock_key)
+        call_command('update_expired_contract')
+        self.assertEqual(Contract.Status.EXPIRED.value, Contract.objects.get(pk=contract.pk).status)
+        self.assertIsNone(cache.get(Command.lock_key))
+
+    def test_calendar_feed(self):
+        u = PUser.get_by_email('test@servuno.com')
+        start = timezone.now() + timedelta(days=1)
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=start, event_end=start + timedelta(hours=2))
+        self.assertTrue(self.client.login(username=u.username, password='password'))
+        url = reverse('contract:my_list')
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('contract-%d' % contract.id, [e['id'] for e in json.loads(response.content.decode())])
+        # nothing changed: 304
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        # incremental sync: the same shape as the full feed, and canceled contracts are marked as removed.
+        since = response['X-Sync-Timestamp']
+        response = self.client.get(url, {'since': since}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([], json.loads(response.content.decode()))
+        contract.cancel()
+        response = self.client.get(url, {'since': since}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([{'id': 'contract-%d' % contract.id, 'removed': True}], json.loads(response.content.decode()))
+
+    def test_progress(self):
+        u = PUser.get_by_email('test@servuno.com')
+        start = timezone.now() + timedelta(days=1)
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=start, event_end=start + timedelta(hours=2))
+        self.assertTrue(self.client.login(username=u.username, password='password'))
+        response = self.client.get(reverse('contract:progress', kwargs={'pk': contract.id}))
+        self.assertEqual(200, response.status_code)
+        # contract_auto_activate has already activated the new contract.
+        self.assertEqual('active', json.loads(response.content.decode())['status'])
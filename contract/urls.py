@@ -30,5 +30,6 @@ urlpatterns = patterns(
     url(r'^response/(?P<pk>\d+)/decline/$', views.MatchStatusChange.as_view(switch=False), name='match_decline'),
     url(r'^api/my_list/$', views.APIMyEngagementList.as_view(), name='my_list'),
     url(r'^api/preview_query/$', views.ContractPreviewQuery.as_view(), name='preview_query'),
+    url(r'^(?P<pk>\d+)/progress/$', views.ContractProgress.as_view(), name='progress'),
     url(r"^(?P<pk>\d+)/match_add/$", views.MatchAdd.as_view(), name="match_add"),        # to make it clear, let's use "activate" instead of "add"
 )
@@ -1,3 +1,4 @@
+import hashlib
 import json
 from datetime import datetime, timedelta
 from decimal import Decimal
@@ -7,9 +8,12 @@ from braces.views import JSONResponseMixin, AjaxResponseMixin, LoginRequiredMixi
 from django.contrib import messages
 from django.core.urlresolvers import reverse_lazy, reverse
 from django.core.validators import MinValueValidator
-from django.db.models import Q
+from django.db.models import Q, Count, Max
+from django.http import HttpResponseNotModified
 from django.views.generic import CreateView, DetailView, ListView, View, TemplateView, UpdateView
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import quote_etag
 
 from django.template.loader import render_to_string
 from django.conf import settings
@@ -18,7 +22,7 @@ from sitetree.sitetreeapp import get_sitetree
 
 from circle.models import Membership
 from contract.forms import ContractForm
-from contract.models import Contract, Match, Engagement
+from contract.models import Contract, Match
 from p2.utils import RegisteredRequiredMixin, is_valid_email, UserRole
 from puser.models import MenuItem, PUser
 from puser.views import ContractAccessMixin
@@ -30,15 +34,16 @@ class ContractDetail(LoginRequiredMixin, ContractAccessMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         contract = self.object
-        matches = contract.match_set.all().order_by('-score', '-updated')
+        matches = contract.match_set.all().select_related('target_user__info').order_by('-score', '-updated')
         circle = contract.initiate_user.to_puser().get_personal_circle(area=contract.area)
 
         existing_uid = set([m.target_user.id for m in matches])
         parent_uid = set([mid for mid in Membership.objects.filter(circle=circle, active=True, as_role=UserRole.PARENT.value).exclude(approved=False).values_list('member__id', flat=True)])
         sitter_uid = set([mid for mid in Membership.objects.filter(circle=circle, active=True, as_role=UserRole.SITTER.value).exclude(approved=False).values_list('member__id', flat=True)])
 
-        parent_candidate_list = PUser.objects.filter(id__in=parent_uid-existing_uid, is_active=True)
-        sitter_candidate_list = PUser.objects.filter(id__in=sitter_uid-existing_uid, is_active=True)
+        parent_candidate_list = list(PUser.objects.with_profile().filter(id__in=parent_uid-existing_uid, is_active=True))
+        sitter_candidate_list = list(PUser.objects.with_profile().filter(id__in=sitter_uid-existing_uid, is_active=True))
+        PUser.preload_profiles([m.target_user for m in matches] + [contract.initiate_user])
 
         context = super().get_context_data(**kwargs)
         context.update({
@@ -329,6 +334,9 @@ class EngagementList(LoginRequiredMixin, RegisteredRequiredMixin, TemplateView):
 
 
 # note: this is not through REST_FRAMEWORK, therefore cannot use browser to view results.
+# supports ETag/If-None-Match, and "since=<iso datetime>" to only return events changed after that time.
+# the response is always a list of events. with "since", events taken off the calendar are {"id": ..., "removed": true},
+# and the X-Sync-Timestamp header is the "since" to use for the next request.
 class APIMyEngagementList(LoginRequiredMixin, JSONResponseMixin, AjaxResponseMixin, View):
 
     def get_ajax(self, request, *args, **kwargs):
@@ -336,29 +344,46 @@ class APIMyEngagementList(LoginRequiredMixin, JSONResponseMixin, AjaxResponseMix
         get_date = lambda s: timezone.make_aware(datetime.strptime(s, '%Y-%m-%d'))
         to_date = lambda d: timezone.localtime(d).isoformat()
         puser = request.puser
+        # taken before the queries, so that changes made during this request show up in the next sync.
+        sync_timestamp = timezone.now()
         start, end = request.GET.get('start', None), request.GET.get('end', None)
         if start and end:
             start, end = get_date(start), get_date(end)
         else:
-            start, end = timezone.now(), (timezone.now() + timedelta(days=30))
-
+            start, end = sync_timestamp, (sync_timestamp + timedelta(days=30))
+        since = parse_datetime(request.GET.get('since', ''))
+        if since is not None and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        # overlapping the range, which works with the (event_start, event_end) index.
+        in_range = lambda qs: qs.filter(event_start__lte=end, event_end__gte=start)
+        qs = in_range(puser.engagement_queryset())
+        if since is not None:
+            qs = qs.filter(Q(updated__gt=since) | Q(match__target_user=puser, match__updated__gt=since))
+
+        # anything that changes an event changes the contract or the match, so the max "updated" is enough for the etag.
+        # the requested parameters are hashed rather than the computed range, which moves with the current time; the default
+        # range is covered by the date.
+        stats = qs.aggregate(count=Count('id', distinct=True), contract_updated=Max('updated'), match_updated=Max('match__updated'))
+        params = (request.GET.get('start', ''), request.GET.get('end', ''), request.GET.get('since', ''))
+        etag = quote_etag(hashlib.md5(('%s:%s:%s:%s:%s:%s:%s:%s' % ((puser.id,) + params + (stats['count'], stats['contract_updated'], stats['match_updated'], timezone.localtime(sync_timestamp).date()))).encode()).hexdigest())
+        if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+            return HttpResponseNotModified()
+
+        # the icons are the same for all events.
+        icon_find, icon_serve = render_to_string('elements/icon_find.html'), render_to_string('elements/icon_serve.html')
         event_list = []
-        all_day = set([])
-        for contract in puser.engagement_queryset().filter(Q(event_start__range=(start, end)) | Q(event_end__range=(start, end))).exclude(status=Contract.Status.CANCELED.value).distinct():
-            if contract.initiate_user == puser:
-                engagement = Engagement.from_contract(contract)
-            else:
-                try:
-                    match = Match.objects.get(contract=contract, target_user=puser)
-                except:
-                    continue
-                engagement = Engagement.from_match(match)
+        if since is None:
+            extra_query = lambda q: in_range(q).exclude(status=Contract.Status.CANCELED.value)
+        else:
+            extra_query = lambda q: q.filter(pk__in=qs.values_list('pk', flat=True))
+        for engagement in puser.engagement_list(extra_query):
+            if not self.is_on_calendar(engagement):
+                if since is not None:
+                    event_list.append({'id': engagement.get_id(), 'removed': True})
+                continue
             status = engagement.display_status()
-            # if engagement.target_user:
-            #     title = '%s <-> %s (%s)' % (engagement.initiate_user.get_name(), engagement.target_user.get_name(), status.label)
-            # else:
-            #     title = '%s (%s)' % (engagement.initiate_user.get_name(), status['label'])
-            title_icon = render_to_string('elements/icon_find.html') if engagement.is_main_contract() else render_to_string('elements/icon_serve.html')
+            title_icon = icon_find if engagement.is_main_contract() else icon_serve
             title_label = engagement.passive_user().get_name() if engagement.passive_user() else ''
             title = '%s: %s' % (title_icon, title_label)
             event = {
@@ -371,23 +396,37 @@ class APIMyEngagementList(LoginRequiredMixin, JSONResponseMixin, AjaxResponseMix
                 'fc-header-class': '.fc-%s' % timezone.localtime(engagement.contract.event_start).strftime('%a').lower()
             }
             event_list.append(event)
-            all_day.add(timezone.localtime(engagement.contract.event_start).date())
-            all_day.add(timezone.localtime(engagement.contract.event_end).date())
 
         # for now, we don't show "allDay" event. the "headline" will do the trick.
         # also disabled allDay event in fullcalendar options. need to turn it on to display the allDay events.
 
-        # for d in all_day:
-        #     event_list.append({
-        #         'allDay': True,
-        #         'start': d.isoformat(),
-        #         'end': d.isoformat(),
-        #         'title': '<i class="fa fa-exclamation-circle"></i>',
-        #         'color': self.color_mapping['danger'],
-        #     })
-
-        return self.render_json_response(event_list)
-        #return self.get(request, *args, **kwargs)
+        response = self.render_json_response(event_list)
+        response['ETag'] = etag
+        response['X-Sync-Timestamp'] = sync_timestamp.isoformat()
+        return response
+
+    def is_on_calendar(self, engagement):
+        # canceled or failed contracts are not shown. a server only sees the contract while still holding the match,
+        # i.e. the match is not declined/canceled, and no other match is confirmed (e.g. after a revert and a new confirm).
+        contract = engagement.contract
+        if contract.status in (Contract.Status.CANCELED.value, Contract.Status.FAILED.value):
+            return False
+        if engagement.is_main_contract():
+            return True
+        match = engagement.match
+        if match.status in (Match.Status.DECLINED.value, Match.Status.CANCELED.value):
+            return False
+        return contract.confirmed_match_id is None or contract.confirmed_match_id == match.id
+
+
+class ContractProgress(LoginRequiredMixin, ContractAccessMixin, SingleObjectMixin, JSONResponseMixin, View):
+    """
+    Polled by the contract page to show the progress of the activation pipeline.
+    """
+    model = Contract
+
+    def get(self, request, *args, **kwargs):
+        return self.render_json_response(self.get_object().activation_progress())
 
 
 class ContractPreviewQuery(LoginRequiredMixin, JSONResponseMixin, AjaxResponseMixin, View):
@@ -0,0 +1,90 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.db import DatabaseError, connection
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+from login_token.conf import settings
+
+
+class AccessBuffer(object):
+    """
+    Write-behind buffer of Token.accessed. Logins only record the time in memory, and the buffered times are written
+    in one UPDATE when the buffer is full, every LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL seconds by a daemon thread, or at exit.
+    Logins within LOGIN_TOKEN_ACCESSED_STALENESS of the last recorded access are not recorded at all.
+    The buffer lives in the web process, so a celery task can't flush it. If the process is killed without running atexit
+    (e.g. SIGKILL, or a worker recycled by uwsgi), the times recorded since the last flush are lost: at most
+    LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL seconds of logins, whose tokens then keep the previous "accessed".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.flushed = time.time()
+        self.thread = None
+        self.pid = None
+
+    def record(self, token_obj, accessed=None):
+        accessed = accessed or timezone.now()
+        if token_obj.accessed is not None and accessed - token_obj.accessed < timedelta(seconds=settings.LOGIN_TOKEN_ACCESSED_STALENESS):
+            return
+        token_obj.accessed = accessed
+        self.start()
+        with self.lock:
+            self.buffer[token_obj.pk] = accessed
+            full = len(self.buffer) >= settings.LOGIN_TOKEN_ACCESSED_BUFFER_SIZE
+        if full or time.time() - self.flushed >= settings.LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        from login_token.models import Token
+        with self.lock:
+            pending, self.buffer = self.buffer, {}
+            self.flushed = time.time()
+        if pending:
+            cases = [When(pk=pk, then=Value(accessed, output_field=DateTimeField())) for pk, accessed in pending.items()]
+            Token.objects.filter(pk__in=pending.keys()).update(accessed=Case(*cases, output_field=DateTimeField()))
+
+    def clear(self):
+        with self.lock:
+            self.buffer = {}
+
+    def start(self):
+        # started by the first record() in each process, so that forked workers get their own thread.
+        if not settings.LOGIN_TOKEN_ACCESSED_FLUSH_THREAD or settings.LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL <= 0:
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='login_token.access')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Failed to flush the login token access times.')
+            finally:
+                # the thread has its own connection; don't keep it open between flushes.
+                connection.close()
+
+
+access_buffer = AccessBuffer()
+
+
+@atexit.register
+def flush_at_exit():
+    # the database might be gone by now, e.g. the test database is destroyed before exit.
+    try:
+        access_buffer.flush()
+    except DatabaseError as e:
+        logging.warning('Login token access times not written at exit: %s' % e)
@@ -1,7 +1,10 @@
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 
+from login_token.access import access_buffer
 from login_token.models import Token
 from login_token.conf import settings
+from login_token.signed import is_signed_token, verify_signed_token
 
 
 # according to https://docs.djangoproject.com/en/1.8/topics/auth/customizing/#writing-an-authentication-backend
@@ -9,16 +12,24 @@ from login_token.conf import settings
 class LoginTokenAuthenticationBackend(ModelBackend):
 
     def authenticate(self, token=''):
+        if is_signed_token(token):
+            return self.authenticate_signed(token)
         if not isinstance(token, str) or len(token) != settings.LOGIN_TOKEN_LENGTH:
             return None
         try:
-            token_obj = Token.objects.get(token=token)
+            token_obj = Token.objects.select_related('user').get(token=token)
             if not token_obj.user.is_active:
                 return None
             else:
-                from django.utils import timezone
-                token_obj.accessed = timezone.now()
-                token_obj.save()
+                # no write here: "accessed" is buffered and written in bulk.
+                access_buffer.record(token_obj)
                 return token_obj.user
         except Token.DoesNotExist:
             return None
+
+    def authenticate_signed(self, token):
+        # verified without the database. only the user is loaded.
+        user_id = verify_signed_token(token)
+        if user_id is None:
+            return None
+        return get_user_model().objects.filter(pk=user_id, is_active=True).first()
@@ -4,4 +4,18 @@ from django.conf import settings
 
 class LoginTokenConfig(AppConf):
     PARAM = 'login_token'
-    LENGTH = 64     # maximum is 64
\ No newline at end of file
+    LENGTH = 64     # maximum is 64
+    # "accessed" is updated only when older than this many seconds, so repeated logins don't write.
+    ACCESSED_STALENESS = 300
+    # buffered "accessed" updates are written in one UPDATE at most this many seconds later. 0 writes right away.
+    ACCESSED_FLUSH_INTERVAL = 60
+    ACCESSED_BUFFER_SIZE = 1000
+    # flush the buffer from a daemon thread in each process, so the times don't wait for the next login.
+    ACCESSED_FLUSH_THREAD = True
+    # when True, forced tokens for notifications are signed (see login_token.signed) instead of written to the Token table.
+    SIGNED = False
+    SIGNED_SALT = 'login_token.signed'
+    # how long a signed token stays valid, in seconds.
+    SIGNED_MAX_AGE = 30 * 24 * 3600
+    # how often each process reloads the revocation list, in seconds.
+    REVOCATION_TTL = 60
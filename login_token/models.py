@@ -64,6 +64,22 @@ class Token(models.Model):
             return None
 
 
+class RevokedToken(models.Model):
+    """
+    Signed tokens of the user issued before "revoked" are invalid. Checked through the in-memory cache in login_token.signed.
+    """
+    user = models.OneToOneField(to=settings.AUTH_USER_MODEL, related_name='+')
+    revoked = models.DateTimeField()
+
+    @staticmethod
+    def revoke(user):
+        from django.utils import timezone
+        from login_token.signed import revocation_cache
+        RevokedToken.objects.update_or_create(user=user, defaults={'revoked': timezone.now()})
+        # other processes pick it up within LOGIN_TOKEN_REVOCATION_TTL.
+        revocation_cache.clear()
+
+
 # this doesn't hanlde missing login_token_token table problem before migrate.
 # @checks.register()
 def login_token_missing_check(app_configs, **kwargs):
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from django.core import signing
+
+from login_token.conf import settings
+
+
+class RevocationCache(object):
+    """
+    In-memory copy of the RevokedToken table as {user_id: revoked timestamp}, reloaded every LOGIN_TOKEN_REVOCATION_TTL seconds.
+    The table only has the users who ever revoked, so it's small and verifying a signed token doesn't hit the database.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.revoked = {}
+        self.loaded = 0
+
+    def is_revoked(self, user_id, issued):
+        if time.time() - self.loaded > settings.LOGIN_TOKEN_REVOCATION_TTL:
+            self.reload()
+        revoked = self.revoked.get(user_id, None)
+        return revoked is not None and issued <= revoked
+
+    def reload(self):
+        from login_token.models import RevokedToken
+        revoked = {user_id: revoked.timestamp() for user_id, revoked in RevokedToken.objects.values_list('user_id', 'revoked')}
+        with self.lock:
+            self.revoked, self.loaded = revoked, time.time()
+
+    def clear(self):
+        with self.lock:
+            self.revoked, self.loaded = {}, 0
+
+
+revocation_cache = RevocationCache()
+
+
+def make_signed_token(user, max_age=None):
+    """
+    HMAC-signed token with the user id, the issue time and the expiry time. Nothing is written to the database.
+    """
+    issued = time.time()
+    expiry = issued + (settings.LOGIN_TOKEN_SIGNED_MAX_AGE if max_age is None else max_age)
+    return signing.dumps({'u': user.pk, 'i': issued, 'e': expiry}, salt=settings.LOGIN_TOKEN_SIGNED_SALT)
+
+
+def verify_signed_token(token):
+    """
+    Return the user id of a valid signed token, or None if the signature is bad, the token expired, or it was revoked.
+    """
+    try:
+        payload = signing.loads(token, salt=settings.LOGIN_TOKEN_SIGNED_SALT)
+        user_id, issued, expiry = payload['u'], payload['i'], payload['e']
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+    if time.time() > expiry or revocation_cache.is_revoked(user_id, issued):
+        return None
+    return user_id
+
+
+def is_signed_token(token):
+    # random tokens are alphanumeric, and signed tokens always have the ":" separator.
+    return isinstance(token, str) and signing.TimestampSigner().sep in token
@@ -1 +1,52 @@
 # Create your tests here.
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from login_token.access import AccessBuffer, access_buffer
+from login_token.auth_backends import LoginTokenAuthenticationBackend
+from login_token.models import Token, RevokedToken
+from login_token.signed import make_signed_token, revocation_cache
+
+
+class LoginTokenTest(TestCase):
+
+    def tearDown(self):
+        # don't leave access times for the atexit flush, which runs after the test database is gone.
+        access_buffer.clear()
+
+    def test_accessed_write_behind(self):
+        user = User.objects.create_user('token_test', 'token_test@servuno.com', 'password')
+        token = Token.generate(user)
+        # one select for the token and the user, and no write. the backend is called directly, because
+        # authenticate() runs ModelBackend first, which makes its own query.
+        with self.settings(LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL=3600), self.assertNumQueries(1):
+            self.assertEqual(user, LoginTokenAuthenticationBackend().authenticate(token=token.token))
+        self.assertIsNone(Token.objects.get(pk=token.pk).accessed)
+        access_buffer.flush()
+        self.assertIsNotNone(Token.objects.get(pk=token.pk).accessed)
+
+    def test_flush_thread(self):
+        buffer = AccessBuffer()
+        with self.settings(LOGIN_TOKEN_ACCESSED_FLUSH_THREAD=True, LOGIN_TOKEN_ACCESSED_FLUSH_INTERVAL=3600):
+            buffer.start()
+            thread = buffer.thread
+            self.assertTrue(thread.is_alive())
+            self.assertTrue(thread.daemon)
+            # one thread per process.
+            buffer.start()
+            self.assertIs(thread, buffer.thread)
+
+    def test_signed_token(self):
+        user = User.objects.create_user('signed_test', 'signed_test@servuno.com', 'password')
+        token = make_signed_token(user)
+        # the revocation list is loaded once per LOGIN_TOKEN_REVOCATION_TTL; after that, only the user is loaded.
+        # the backend is called directly, because authenticate() runs ModelBackend first, which makes its own query.
+        revocation_cache.reload()
+        with self.assertNumQueries(1):
+            self.assertEqual(user, LoginTokenAuthenticationBackend().authenticate(token=token))
+        self.assertIsNone(authenticate(token=token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+        self.assertIsNone(authenticate(token=make_signed_token(user, max_age=-1)))
+        RevokedToken.revoke(user)
+        self.assertIsNone(authenticate(token=token))
+        self.assertFalse(Token.objects.filter(user=user).exists())
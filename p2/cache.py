@@ -0,0 +1,73 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from p2.profiling import profiler
+
+
+class UserCache(object):
+    """
+    Cache-aside layer for data derived per user, e.g. the engagement headline or the level.
+    Keys are "user:<namespace>:<user_id>:<version>". Each user has a version token, and invalidating a user replaces the token,
+    which drops all namespaces of the user at once. Invalidation is triggered by Contract/Match/Membership signals.
+    """
+    NAMESPACES = ('headline', 'level', 'personal_circle')
+
+    def get_version(self, user_id):
+        version_key = 'user:version:%d' % user_id
+        version = cache.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.set(version_key, version, None)
+        return version
+
+    def make_key(self, namespace, user_id, suffix=''):
+        assert namespace in self.NAMESPACES, 'Unknown cache namespace: %s' % namespace
+        return 'user:%s:%d:%s%s' % (namespace, user_id, self.get_version(user_id), suffix)
+
+    def get_or_set(self, namespace, user_id, compute, suffix='', timeout=None):
+        """
+        Return the cached value, or compute and cache it. None is a valid value to cache.
+        """
+        key = self.make_key(namespace, user_id, suffix)
+        cached = cache.get(key)
+        profiler.cache_hit(cached is not None)
+        if cached is not None:
+            return cached[0]
+        value = compute()
+        cache.set(key, (value,), settings.USER_CACHE_TIMEOUT if timeout is None else timeout)
+        return value
+
+    def get_versions(self, user_ids):
+        version_keys = {user_id: 'user:version:%d' % user_id for user_id in user_ids}
+        found = cache.get_many(version_keys.values())
+        versions, missing = {}, {}
+        for user_id, version_key in version_keys.items():
+            versions[user_id] = found.get(version_key, None)
+            if versions[user_id] is None:
+                versions[user_id] = missing[version_key] = uuid.uuid4().hex
+        if missing:
+            cache.set_many(missing, None)
+        return versions
+
+    def get_many(self, namespace, user_ids, suffix=''):
+        """
+        Bulk get of the cached values, with 2 cache calls for any number of users. Returns {user_id: value} of the cached ones.
+        """
+        assert namespace in self.NAMESPACES, 'Unknown cache namespace: %s' % namespace
+        keys = {'user:%s:%d:%s%s' % (namespace, user_id, version, suffix): user_id for user_id, version in self.get_versions(user_ids).items()}
+        found = cache.get_many(keys.keys())
+        for key in keys:
+            profiler.cache_hit(key in found)
+        return {keys[key]: cached[0] for key, cached in found.items()}
+
+    def set_many(self, namespace, values, suffix='', timeout=None):
+        versions = self.get_versions(values.keys())
+        cache.set_many({'user:%s:%d:%s%s' % (namespace, user_id, versions[user_id], suffix): (value,) for user_id, value in values.items()}, settings.USER_CACHE_TIMEOUT if timeout is None else timeout)
+
+    def invalidate(self, user_ids):
+        cache.set_many({'user:version:%d' % user_id: uuid.uuid4().hex for user_id in user_ids if user_id is not None}, None)
+
+
+user_cache = UserCache()
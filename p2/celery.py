@@ -1,6 +1,11 @@
+import logging
 import os
+from collections import defaultdict
+from datetime import datetime, date
+from decimal import Decimal
 
-from celery import Celery
+from celery import Celery, Task
+from celery.signals import task_prerun, task_postrun
 
 
 # set the default Django settings module for the 'celery' program.
@@ -10,7 +15,106 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'p2.settings')
 
 from django.conf import settings
 
-app = Celery('p2')
+
+class ModelTask(Task):
+    """
+    Base class of all tasks. Model instances in the arguments are sent to the broker as (app_label, model, pk) references
+    and loaded again in the worker, so the messages stay small and can be serialized with json instead of pickle.
+    Nested lists/tuples/dicts (e.g. the "ctx" of notify_send) are handled too. Calling the task directly is not affected.
+    The referenced instances are loaded with one query per model. If a referenced row was deleted before the task runs, the task is skipped.
+    """
+    abstract = True
+
+    # related objects to load together with the referenced instance in the worker.
+    select_related = {
+        'contract.contract': ('initiate_user', 'confirmed_match__target_user', 'area'),
+        'contract.match': ('contract__initiate_user', 'contract__area', 'target_user'),
+        'circle.circle': ('owner', 'area'),
+        'circle.membership': ('circle__owner', 'member'),
+        'shout.shout': ('from_user',),
+    }
+
+    def apply_async(self, args=None, kwargs=None, *options_args, **options):
+        args = self.dehydrate(args) if args else args
+        kwargs = self.dehydrate(kwargs) if kwargs else kwargs
+        return super().apply_async(args, kwargs, *options_args, **options)
+
+    def __call__(self, *args, **kwargs):
+        from django.core.exceptions import ObjectDoesNotExist
+        try:
+            args, kwargs = self.rehydrate(args), self.rehydrate(kwargs)
+        except ObjectDoesNotExist as e:
+            # a normal race (e.g. the contract was deleted after the task was queued), not worth a failure and a retry.
+            logging.warning('Skip task %s, referenced object no longer exists: %s' % (self.name, e))
+            return None
+        return super().__call__(*args, **kwargs)
+
+    def dehydrate(self, value):
+        from django.db.models import Model, QuerySet
+        if isinstance(value, Model):
+            if value.pk is None:
+                raise ValueError('Unsaved %s instance cannot be sent to task %s.' % (value.__class__.__name__, self.name))
+            return {'__model__': [value._meta.app_label, value._meta.model_name, value.pk]}
+        elif isinstance(value, dict):
+            return {k: self.dehydrate(v) for k, v in value.items()}
+        elif isinstance(value, (list, tuple, set, QuerySet)):
+            return [self.dehydrate(v) for v in value]
+        elif isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        elif isinstance(value, date):
+            return {'__date__': value.isoformat()}
+        elif isinstance(value, Decimal):
+            return {'__decimal__': str(value)}
+        return value
+
+    def rehydrate(self, value):
+        from django.apps import apps
+        references = defaultdict(set)
+        self.collect_references(value, references)
+        instances = {}
+        for (app_label, model_name), pks in references.items():
+            model = apps.get_model(app_label, model_name)
+            loaded = model._default_manager.select_related(*self.select_related.get('%s.%s' % (app_label, model_name), ())).in_bulk(list(pks))
+            missing = pks - set(loaded)
+            if missing:
+                raise model.DoesNotExist('%s matching pk %s does not exist.' % (model.__name__, ', '.join(str(pk) for pk in missing)))
+            for pk, instance in loaded.items():
+                instances[(app_label, model_name, pk)] = instance
+        return self.restore(value, instances)
+
+    def collect_references(self, value, references):
+        # {(app_label, model_name): set of pks} of all the references in the arguments.
+        if isinstance(value, dict):
+            if '__model__' in value:
+                app_label, model_name, pk = value['__model__']
+                references[(app_label, model_name)].add(pk)
+            else:
+                for v in value.values():
+                    self.collect_references(v, references)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                self.collect_references(v, references)
+
+    def restore(self, value, instances):
+        if isinstance(value, dict):
+            if '__model__' in value:
+                return instances[tuple(value['__model__'])]
+            elif '__datetime__' in value:
+                from django.utils.dateparse import parse_datetime
+                return parse_datetime(value['__datetime__'])
+            elif '__date__' in value:
+                from django.utils.dateparse import parse_date
+                return parse_date(value['__date__'])
+            elif '__decimal__' in value:
+                return Decimal(value['__decimal__'])
+            return {k: self.restore(v, instances) for k, v in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self.restore(v, instances) for v in value)
+        return value
+
+
+# ModelTask is the base of all tasks, including @shared_task.
+app = Celery('p2', task_cls=ModelTask)
 
 # Using a string here means the worker will not have to
 # pickle the object when using Windows.
@@ -18,6 +122,34 @@ app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 
+# the user identity map is scoped to each task, see puser.identity.
+@task_prerun.connect
+def identity_map_task_prerun(**kwargs):
+    from puser.identity import identity_map
+    identity_map.begin()
+
+
+@task_postrun.connect
+def identity_map_task_postrun(**kwargs):
+    from puser.identity import identity_map
+    identity_map.end()
+
+
+# per task query count and latency, see p2.profiling.
+@task_prerun.connect
+def profiling_task_prerun(task=None, **kwargs):
+    if settings.PROFILING_ENABLED:
+        from p2.profiling import profiler
+        profiler.start('task', task.name)
+
+
+@task_postrun.connect
+def profiling_task_postrun(**kwargs):
+    if settings.PROFILING_ENABLED:
+        from p2.profiling import profiler
+        profiler.stop()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
@@ -0,0 +1,119 @@
+import json
+import logging
+import random
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from circle.graph import social_graph
+from circle.models import Circle, UserConnection
+from circle.views import DiscoverView
+from contract.algorithms import ExtendedNetworkRecommender
+from contract.models import Contract
+from contract.views import APIMyEngagementList
+from p2 import synthetic
+from p2.utils import UserRole
+from puser.models import PUser
+
+
+class Command(BaseCommand):
+    help = 'Time the hot paths on the synthetic network, and print the results in JSON to compare across commits.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='', help='Comma separated numbers of users, e.g. "1000,10000,100000". The synthetic network is regenerated for each. Runs on the existing data if omitted.')
+        parser.add_argument('--sample', type=int, default=20, help='Number of users to run each path with.')
+        parser.add_argument('--targets', type=int, default=50, help='Number of target users for trust_level.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='synthetic')
+        parser.add_argument('--output', default=None, help='Write the JSON results to the file instead of stdout.')
+
+    def measure(self, func, runs):
+        timings, queries = [], []
+        for args in runs:
+            with CaptureQueriesContext(connection) as context:
+                start = time.time()
+                func(*args)
+                timings.append((time.time() - start) * 1000)
+            queries.append(len(context.captured_queries))
+        if not timings:
+            return {'runs': 0}
+        timings.sort()
+        return {
+            'runs': len(timings),
+            'mean_ms': round(sum(timings) / len(timings), 3),
+            'p50_ms': round(timings[len(timings) // 2], 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+            'max_ms': round(timings[-1], 3),
+            'queries': round(sum(queries) / len(queries), 1),
+        }
+
+    def run_paths(self, prefix, sample, targets, rnd):
+        owners = list(Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner__username__startswith=prefix).values_list('owner_id', flat=True))
+        users = list(PUser.objects.filter(id__in=rnd.sample(owners, min(sample, len(owners)))))
+        all_ids = list(PUser.objects.filter(username__startswith=prefix).values_list('id', flat=True))
+        factory = RequestFactory()
+
+        def trust_level(user, target_ids):
+            social_graph.clear()
+            for target_id in target_ids:
+                UserConnection(user, PUser(id=target_id)).trust_level()
+
+        def recommend(contract):
+            # the matches added by the recommender are rolled back, so every run starts the same.
+            with transaction.atomic():
+                ExtendedNetworkRecommender(contract).recommend()
+                transaction.set_rollback(True)
+
+        def get_extended(user):
+            view = DiscoverView()
+            view.object = user
+            view.get_extended(UserRole.SITTER.value)
+            view.get_extended(UserRole.PARENT.value)
+
+        def api_engagement_list(user):
+            request = factory.get('/contract/api/engagement/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            request.user = request.puser = user
+            APIMyEngagementList.as_view()(request)
+
+        contracts = list(Contract.objects.filter(initiate_user__in=users, status=Contract.Status.ACTIVE.value, event_start__gt=timezone.now()).select_related('initiate_user', 'area'))
+        return {
+            'trust_level': self.measure(trust_level, [(u, rnd.sample(all_ids, min(targets, len(all_ids)))) for u in users]),
+            'recommend': self.measure(recommend, [(c,) for c in contracts[:sample]]),
+            'get_extended': self.measure(get_extended, [(u,) for u in users]),
+            'engagement_list': self.measure(lambda u: u.engagement_list(), [(u,) for u in users]),
+            'api_engagement_list': self.measure(api_engagement_list, [(u,) for u in users]),
+        }
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        try:
+            revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            revision = None
+        output = {'revision': revision, 'database': connection.vendor, 'created': timezone.now().isoformat(), 'results': []}
+
+        scales = [int(s) for s in options['scales'].split(',') if s.strip()] or [None]
+        for scale in scales:
+            if scale is not None:
+                logging.info('Generating synthetic network with %d users.' % scale)
+                synthetic.clear(prefix)
+                counts = synthetic.generate(users=scale, seed=options['seed'], prefix=prefix)
+                synthetic.refresh_extended(prefix)
+            else:
+                counts = {'users': PUser.objects.filter(username__startswith=prefix).count()}
+            # each scale uses the same random sequence, so the numbers are comparable across commits.
+            paths = self.run_paths(prefix, options['sample'], options['targets'], random.Random(options['seed']))
+            output['results'].append({'scale': scale, 'counts': counts, 'paths': paths})
+
+        result = json.dumps(output, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(result)
+        else:
+            self.stdout.write(result)
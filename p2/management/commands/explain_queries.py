@@ -0,0 +1,96 @@
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from circle.models import Circle, Membership
+from contract.models import Contract, Match
+from p2 import synthetic
+from p2.utils import UserRole
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Print the query plan and the timing of the hot filters, to review whether they are served by an index.'
+
+    # the composite indexes for the hot filters (circle 0019 and contract 0007), dropped temporarily with --compare.
+    composite_indexes = (
+        (Circle, {('owner', 'type', 'area')}),
+        (Membership, {('circle', 'active', 'approved', 'as_role'), ('member', 'active', 'approved')}),
+        (Contract, {('status', 'event_start'), ('status', 'event_end'), ('initiate_user', 'status')}),
+        (Match, {('contract', 'status'), ('target_user', 'status')}),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0, help='Generate a synthetic network with the number of users first.')
+        parser.add_argument('--user', type=int, default=None, help='The user id to run the per-user queries with.')
+        parser.add_argument('--compare', action='store_true', default=False, help='Also print the plans without the composite indexes, which are dropped in a transaction that is rolled back.')
+
+    def explain(self, title, qs):
+        sql, params = qs.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            plan = cursor.fetchall()
+            start = time.time()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            elapsed = time.time() - start
+        self.stdout.write('== %s (%.2f ms)' % (title, elapsed * 1000))
+        for row in plan:
+            self.stdout.write('  ' + ' | '.join(str(col) for col in row))
+
+    def handle(self, *args, **options):
+        if options['compare'] and not connection.features.can_rollback_ddl:
+            raise CommandError('--compare needs a database that can roll back schema changes, e.g. sqlite or postgresql.')
+        if options['synthetic']:
+            synthetic.generate(users=options['synthetic'])
+
+        user_id = options['user'] or Circle.objects.filter(type=Circle.Type.PERSONAL.value).order_by('-id').values_list('owner_id', flat=True).first()
+        circle = Circle.objects.filter(owner_id=user_id, type=Circle.Type.PERSONAL.value).first()
+        if circle is None:
+            raise CommandError('No personal circle to run the queries with. Use --synthetic to generate data, or --user with a user who has a personal circle.')
+
+        queries = self.get_queries(user_id, circle)
+        if not options['compare']:
+            for title, qs in queries:
+                self.explain(title, qs)
+            return
+
+        self.stdout.write('######## with the composite indexes')
+        for title, qs in queries:
+            self.explain(title, qs)
+        try:
+            with transaction.atomic():
+                with connection.schema_editor() as editor:
+                    for model, dropped in self.composite_indexes:
+                        current = set(model._meta.index_together)
+                        editor.alter_index_together(model, current, current - dropped)
+                self.stdout.write('######## without the composite indexes')
+                for title, qs in queries:
+                    self.explain(title, qs)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def get_queries(self, user_id, circle):
+        now = timezone.now()
+        personal = Circle.Type.PERSONAL.value
+        confirmed_status = (Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)
+        my_network = Membership.objects.filter(circle__type=personal, circle__owner_id=user_id, active=True, approved=True).values_list('member_id', flat=True)
+        return [
+            ('personal circle lookup', Circle.objects.filter(owner_id=user_id, type=personal, area_id=circle.area_id)),
+            ('personal circle members', Membership.objects.filter(circle=circle, active=True, approved=True, as_role=UserRole.SITTER.value).values_list('member_id', flat=True)),
+            ('circles a user belongs to', Membership.objects.filter(member_id=user_id, active=True, approved=True).values_list('circle_id', flat=True)),
+            ('shared connections', Membership.objects.filter(circle__type=personal, circle__owner_id__in=my_network, active=True, approved=True).values_list('member_id', 'circle__owner_id')),
+            ('confirmed contracts of a user', Contract.objects.filter(status__in=confirmed_status, initiate_user_id=user_id)),
+            ('engagement list', Contract.objects.filter(initiate_user_id=user_id, event_end__gte=now).order_by('event_start')),
+            ('matches of a user', Match.objects.filter(target_user_id=user_id, status=Match.Status.ENGAGED.value)),
+            ('matches of a contract', Match.objects.filter(contract__initiate_user_id=user_id, status=Match.Status.ACCEPTED.value)),
+            ('expired contracts', Contract.objects.filter(status=Contract.Status.ACTIVE.value, event_start__lt=now)),
+            ('finished contracts', Contract.objects.filter(status=Contract.Status.CONFIRMED.value, event_end__lt=now)),
+        ]
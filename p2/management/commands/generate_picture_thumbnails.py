@@ -0,0 +1,37 @@
+import logging
+from multiprocessing import Pool
+
+from django.core.management import BaseCommand
+from django.db import connection
+
+from puser.models import Info
+from puser.tasks import generate_picture_thumbnail
+
+
+def generate(user_id):
+    try:
+        return user_id, generate_picture_thumbnail(user_id)
+    except Exception as e:
+        logging.error('Failed to generate picture thumbnail for user %d: %s' % (user_id, e))
+        return user_id, None
+
+
+class Command(BaseCommand):
+    help = 'Generate the cropped thumbnails of the existing user pictures with a process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None, help='Number of worker processes. Default to the number of CPUs.')
+        parser.add_argument('--all', action='store_true', help='Regenerate the thumbnails already generated too.')
+
+    def handle(self, *args, **options):
+        qs = Info.objects.exclude(picture_original='').exclude(picture_original__isnull=True)
+        if not options['all']:
+            qs = qs.filter(picture_thumbnail='')
+        user_ids = list(qs.values_list('user_id', flat=True))
+        logging.info('Total pictures to generate thumbnails: %s' % len(user_ids))
+
+        # the forked workers must open their own database connections.
+        connection.close()
+        with Pool(options['processes']) as pool:
+            done = sum(1 for user_id, url in pool.imap_unordered(generate, user_ids, chunksize=10) if url)
+        logging.info('Generated picture thumbnails: %s' % done)
@@ -0,0 +1,36 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from p2 import synthetic
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic network of areas, users, circles, memberships, contracts and matches in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--areas', type=int, default=1)
+        parser.add_argument('--degree', type=int, default=10, help='Mean number of members in a personal circle.')
+        parser.add_argument('--sitter-ratio', type=float, default=0.2)
+        parser.add_argument('--public-circles', type=int, default=10, help='Number of public circles per area.')
+        parser.add_argument('--group-size', type=int, default=30, help='Mean number of members in a public circle.')
+        parser.add_argument('--contracts', type=int, default=2, help='Number of contracts per parent.')
+        parser.add_argument('--matches', type=int, default=5, help='Number of matches per contract.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='synthetic')
+        parser.add_argument('--clear', action='store_true', help='Remove the previously generated network with the same prefix first.')
+        parser.add_argument('--no-extended', action='store_true', help='Skip precomputing the extended network.')
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if options['clear']:
+            logging.info('Removing synthetic network: %s' % prefix)
+            synthetic.clear(prefix)
+        counts = synthetic.generate(users=options['users'], areas=options['areas'], degree=options['degree'], sitter_ratio=options['sitter_ratio'],
+                                    public_circles=options['public_circles'], group_size=options['group_size'], contracts_per_user=options['contracts'],
+                                    matches_per_contract=options['matches'], seed=options['seed'], prefix=prefix)
+        if not options['no_extended']:
+            logging.info('Refreshing extended network.')
+            synthetic.refresh_extended(prefix)
+        self.stdout.write(str(counts))
@@ -0,0 +1,24 @@
+import json
+
+from django.core.management import BaseCommand
+
+from p2.profiling import profiler
+
+
+class Command(BaseCommand):
+    help = 'Dump the per view/task query count and latency collected by the running processes (see p2.profiling).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', default='queries_mean', help='The stat to sort by, in descending order.')
+        parser.add_argument('--reset', action='store_true', help='Remove the collected stats after the dump.')
+
+    def handle(self, *args, **options):
+        rows = []
+        for process, stats in profiler.collect().items():
+            for stat in stats:
+                stat['process'] = process
+                rows.append(stat)
+        rows.sort(key=lambda r: r.get(options['sort']) or 0, reverse=True)
+        self.stdout.write(json.dumps(rows, indent=2))
+        if options['reset']:
+            profiler.reset()
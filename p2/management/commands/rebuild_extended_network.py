@@ -0,0 +1,15 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from circle.models import Circle, ExtendedNetwork
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed friends-of-friends network for all users with a personal circle.'
+
+    def handle(self, *args, **options):
+        qs = Circle.objects.filter(type=Circle.Type.PERSONAL.value).values_list('owner_id', 'area_id').distinct()
+        logging.info('Total personal circles to rebuild extended network: %s' % qs.count())
+        for owner_id, area_id in qs:
+            ExtendedNetwork.refresh(owner_id, area_id)
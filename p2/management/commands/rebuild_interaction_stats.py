@@ -0,0 +1,13 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from contract.models import InteractionStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the served/favors counters between users from the successful contracts.'
+
+    def handle(self, *args, **options):
+        InteractionStats.rebuild()
+        logging.info('Total interaction stats rows: %s' % InteractionStats.objects.count())
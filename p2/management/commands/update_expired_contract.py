@@ -1,6 +1,8 @@
 import logging
+import uuid
 from datetime import timedelta
 
+from django.core.cache import cache
 from django.core.management import BaseCommand
 from django.utils import timezone
 
@@ -10,16 +12,33 @@ from contract.models import Contract
 class Command(BaseCommand):
     help = 'Update expired contracts and mark them as successful, or purge them for archival purposes.'
 
+    # held while running, so that runs from cron don't overlap. expires in case a run dies.
+    # bulk_change_status() is idempotent and locks its rows, so the rare overlap this doesn't catch is harmless.
+    lock_key = 'update_expired_contract:lock'
+    lock_timeout = 600
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of contracts to update in one transaction.')
+
     def handle(self, *args, **options):
+        token = uuid.uuid4().hex
+        # cache.add() is not atomic on every backend (e.g. FileBasedCache), so read the lock back to see which run got it.
+        if not cache.add(self.lock_key, token, self.lock_timeout) or cache.get(self.lock_key) != token:
+            logging.info('Another run of update_expired_contract is in progress. Skip.')
+            return
+        try:
+            self.update(options['batch_size'])
+        finally:
+            # a run that took longer than lock_timeout doesn't hold the lock anymore: don't release the next run's lock.
+            if cache.get(self.lock_key) == token:
+                cache.delete(self.lock_key)
+
+    def update(self, batch_size):
         # after 7 days, if still not marked as successful, we'll mark as successful.
         cutoff = timezone.now() - timedelta(days=7)
-        qs = Contract.objects.filter(status=Contract.Status.CONFIRMED.value, event_end__lt=cutoff)
-        logging.info('Total expired contracts to mark as successful (7 days ago): %s' % qs.count())
-        for contract in qs:
-            contract.status = Contract.Status.SUCCESSFUL.value
-            contract.save()
-        qs = Contract.objects.filter(status__in=(Contract.Status.ACTIVE.value, Contract.Status.INITIATED.value), event_end__lt=cutoff)
-        logging.info('Total expired contracts to mark as expired (7 days ago): %s' % qs.count())
-        for contract in qs:
-            contract.status = Contract.Status.EXPIRED.value
-            contract.save()
+        qs = Contract.objects.filter(event_end__lt=cutoff)
+        count = Contract.bulk_change_status(qs, Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value, batch_size)
+        logging.info('Total expired contracts marked as successful (7 days ago): %s' % count)
+        for status in (Contract.Status.ACTIVE.value, Contract.Status.INITIATED.value):
+            count = Contract.bulk_change_status(qs, status, Contract.Status.EXPIRED.value, batch_size)
+            logging.info('Total expired contracts marked as expired from %s (7 days ago): %s' % (Contract.Status(status).name, count))
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from p2.profiling import profiler
+
+
+class ProfilingMiddleware(object):
+    """
+    Record query count, db time, cache hits/misses and wall time per view class. Enabled with settings.PROFILING_ENABLED.
+    Put it first in MIDDLEWARE_CLASSES to include the queries of the other middleware.
+    """
+
+    def __init__(self):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        profiler.start('view', request.path_info)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # as_view() copies the name and module of the class to the view function.
+        record = profiler.current()
+        if record is not None:
+            record.name = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        # the role is looked up after the counters are final, so its queries are not counted.
+        profiler.stop(role=lambda: self.get_role(request))
+        return response
+
+    def get_role(self, request):
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated():
+            return 'anonymous'
+        puser = request.puser
+        return 'staff' if puser.is_staff else str(puser.get_role())
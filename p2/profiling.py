@@ -0,0 +1,147 @@
+import os
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+
+class ProfileRecord(object):
+    """
+    Counters of one request or task. Queries are captured with CaptureQueriesContext on each connection, so it works without DEBUG.
+    The query log is reset at the start, so it doesn't run into the max length of the log in long-living workers.
+    """
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.role = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.start = time.time()
+        reset_queries()
+        self.captures = [CaptureQueriesContext(conn) for conn in connections.all()]
+        for capture in self.captures:
+            capture.__enter__()
+
+    def finish(self):
+        self.wall_time = time.time() - self.start
+        self.queries, self.db_time = 0, 0.0
+        for capture in self.captures:
+            capture.__exit__(None, None, None)
+            self.queries += len(capture)
+            self.db_time += sum(float(q['time']) for q in capture.captured_queries)
+
+
+class Profiler(object):
+    """
+    Rolling in-process aggregate of query count, db time, cache hits/misses and wall time per view class or celery task (and user role).
+    Only the last settings.PROFILING_SAMPLES samples of each key are kept. Every settings.PROFILING_FLUSH_INTERVAL seconds
+    the aggregate is written to the cache, so the profiling_stats command and the staff endpoint can merge all processes.
+    Each process claims one of settings.PROFILING_MAX_PROCESSES slot keys with cache.add(), so processes don't overwrite each other.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.samples = defaultdict(lambda: deque(maxlen=settings.PROFILING_SAMPLES))
+        self.flushed = time.time()
+        self.process_key = 'profiling:%s:%d' % (socket.gethostname(), os.getpid())
+        self.slot = None
+
+    def start(self, kind, name):
+        # a record left over by a request that didn't get to process_response() still holds the connections.
+        if self.current() is not None:
+            self.current().finish()
+        self.local.record = ProfileRecord(kind, name)
+        return self.local.record
+
+    def current(self):
+        return getattr(self.local, 'record', None)
+
+    def stop(self, role=None):
+        """
+        Finish the current record. role is the user role to record, or a callable that returns it, which is called after the counters
+        are final so that its own queries are not counted.
+        """
+        record = self.current()
+        if record is None:
+            return None
+        self.local.record = None
+        record.finish()
+        if callable(role):
+            role = role()
+        if role is not None:
+            record.role = role
+        with self.lock:
+            self.samples[(record.kind, record.name, record.role)].append((record.queries, record.db_time, record.cache_hits, record.cache_misses, record.wall_time))
+        if time.time() - self.flushed > settings.PROFILING_FLUSH_INTERVAL:
+            self.flush()
+        return record
+
+    def cache_hit(self, hit):
+        record = self.current()
+        if record is not None:
+            if hit:
+                record.cache_hits += 1
+            else:
+                record.cache_misses += 1
+
+    def snapshot(self):
+        stats = []
+        with self.lock:
+            items = [(key, list(samples)) for key, samples in self.samples.items()]
+        for (kind, name, role), samples in items:
+            n = len(samples)
+            walls = sorted(s[4] for s in samples)
+            stats.append({
+                'kind': kind, 'name': name, 'role': role, 'count': n,
+                'queries_mean': sum(s[0] for s in samples) / n,
+                'queries_max': max(s[0] for s in samples),
+                'db_ms_mean': sum(s[1] for s in samples) / n * 1000,
+                'cache_hits': sum(s[2] for s in samples),
+                'cache_misses': sum(s[3] for s in samples),
+                'wall_ms_mean': sum(walls) / n * 1000,
+                'wall_ms_p95': walls[min(n - 1, int(n * 0.95))] * 1000,
+            })
+        return stats
+
+    def slot_keys(self):
+        return ['profiling:slot:%d' % i for i in range(settings.PROFILING_MAX_PROCESSES)]
+
+    def flush(self):
+        self.flushed = time.time()
+        value, timeout = (self.process_key, self.snapshot()), settings.PROFILING_FLUSH_INTERVAL * 10
+        # keep the slot as long as it's still ours; it might have expired and been claimed by another process.
+        if self.slot is not None:
+            claimed = cache.get(self.slot)
+            if claimed is not None and claimed[0] == self.process_key:
+                cache.set(self.slot, value, timeout)
+                return
+            self.slot = None
+        for slot in self.slot_keys():
+            if cache.add(slot, value, timeout):
+                self.slot = slot
+                return
+
+    def collect(self):
+        """
+        Stats of all processes that flushed recently, keyed by process.
+        """
+        if self.samples:
+            self.flush()
+        # the slots of the processes that are gone have expired.
+        return dict(cache.get_many(self.slot_keys()).values())
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+        cache.delete_many(self.slot_keys())
+        self.slot = None
+
+
+profiler = Profiler()
@@ -70,6 +70,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'p2.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -144,17 +145,43 @@ BROKER_URL = 'sqla+sqlite:///celerydb.sqlite3'
 # CELERY_RESULT_BACKEND = 'db+sqlite:///celerydb.sqlite3'
 # BROKER_URL = 'django://'
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
-CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml']
-# CELERY_ACCEPT_CONTENT = ['json']
-# CELERY_TASK_SERIALIZER = 'json'
-# CELERY_RESULT_SERIALIZER = 'json'
-
+# model instances in task arguments are sent as references (see p2.celery.ModelTask), so json works and pickle isn't accepted.
+CELERY_ACCEPT_CONTENT = ['json', 'msgpack']
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+
+# file based cache works without other services. override in settings_local.py with memcached etc. in production.
+# p2.cache and circle.graph keep a few entries per user, including version keys that never expire, so the default
+# limit of 300 entries would cull them all the time.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR_ASSETS, 'cache'),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
     }
 }
 
+# how long to keep per-user derived data (see p2.cache). entries are also invalidated on changes.
+USER_CACHE_TIMEOUT = 300
+
+# in-memory social graph index (see circle.graph). entries are invalidated across processes through version keys in the cache,
+# and also expire as a backstop for writes that bypass the signals.
+SOCIAL_GRAPH_TTL = 300
+SOCIAL_GRAPH_MAX_USERS = 10000
+
+# how many matches to create synchronously when a contract is activated. the rest is recommended in the background.
+CONTRACT_INITIAL_MATCHES = 5
+
+# per view/task query count and latency (see p2.profiling). dump with "manage.py profiling_stats" or at /profiling/ as staff.
+PROFILING_ENABLED = False
+PROFILING_SAMPLES = 200
+PROFILING_FLUSH_INTERVAL = 30
+# max number of processes whose stats are kept in the cache.
+PROFILING_MAX_PROCESSES = 64
+
 ################# email related ####################
 
 DEFAULT_FROM_EMAIL = 'Servuno.com <admin@servuno.com>'
@@ -168,6 +195,13 @@ AWS_SECRET_ACCESS_KEY = 'cdNAyD16yomoHQhwcvQgIniUZa7TLy6a2JDGG+nd'
 # AWS_SES_REGION_NAME = 'us-east-1'
 # AWS_SES_REGION_ENDPOINT = 'email.us-east-1.amazonaws.com'
 
+# inside notify_agent.batch(), messages are sent over one connection in batches of this size.
+NOTIFY_BATCH_SIZE = 50
+# max messages per second when sending a batch (e.g. SES sending rate). 0 means no limit.
+NOTIFY_RATE_LIMIT = 0
+# how long each process keeps the site admin user of notifications (see shout.notify.SystemIdentity).
+SYSTEM_IDENTITY_TTL = 300
+
 # use dummy email for dev
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 
@@ -351,3 +385,17 @@ try:
     from p2.settings_local import *
 except ImportError:
     logging.warning('local settings not found.')
+
+
+################## test overrides ###################
+
+# tests clear the cache (see p2.utils.TestEnvMixin), so they never use the cache configured above or in settings_local.py.
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'p2-test',
+        }
+    }
+    # the test transaction isn't visible to other threads, so tests flush the login token access times explicitly.
+    LOGIN_TOKEN_ACCESSED_FLUSH_THREAD = False
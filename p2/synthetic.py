@@ -0,0 +1,124 @@
+"""
+Synthetic social network for benchmarks and query plan review. Everything is created with bulk_create, so no signals/tasks are fired.
+All users are named "<prefix><n>" and all areas "<prefix> <n>", so that the data could be removed with clear().
+Contracts are found through the username of their initiate user; audience_data is left empty (it's parsed as JSON by the recommenders).
+"""
+
+import logging
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from p2.utils import UserRole
+
+
+def sample_degree(rnd, mean, cap):
+    # heavy tailed (pareto) degree: most users have a few connections, some have many.
+    alpha = 2.0
+    return max(1, min(cap, int(rnd.paretovariate(alpha) * mean * (alpha - 1) / alpha)))
+
+
+def generate(users=1000, areas=1, degree=10, sitter_ratio=0.2, public_circles=10, group_size=30, contracts_per_user=2, matches_per_contract=5, seed=0, prefix='synthetic', batch_size=1000):
+    """
+    Create the synthetic network, and return the counts of created rows.
+    """
+    from puser.models import Area, Info
+    from circle.models import Circle, Membership
+    from contract.models import Contract, Match, InteractionStats
+
+    rnd = random.Random(seed)
+    now = timezone.now()
+    counts = {}
+
+    with transaction.atomic():
+        Area.objects.bulk_create([Area(name='%s %d' % (prefix, i), state='MI') for i in range(areas)])
+        area_ids = list(Area.objects.filter(name__startswith='%s ' % prefix).order_by('id').values_list('id', flat=True))[-areas:]
+
+        User.objects.bulk_create([User(username='%s%d' % (prefix, i), email='%s%d@example.com' % (prefix, i), is_active=True, password='!') for i in range(users)], batch_size=batch_size)
+        user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))[-users:]
+        user_area = {user_id: rnd.choice(area_ids) for user_id in user_ids}
+        user_role = {user_id: UserRole.SITTER.value if rnd.random() < sitter_ratio else UserRole.PARENT.value for user_id in user_ids}
+        Info.objects.bulk_create([Info(user_id=user_id, area_id=user_area[user_id], role=user_role[user_id]) for user_id in user_ids], batch_size=batch_size)
+        counts['users'] = len(user_ids)
+
+        by_area = {area_id: [] for area_id in area_ids}
+        for user_id in user_ids:
+            by_area[user_area[user_id]].append(user_id)
+
+        # personal circles of the parents, with members from the same area.
+        parents = [user_id for user_id in user_ids if user_role[user_id] == UserRole.PARENT.value]
+        Circle.objects.bulk_create([Circle(name='%s:personal' % user_id, type=Circle.Type.PERSONAL.value, owner_id=user_id, area_id=user_area[user_id]) for user_id in parents], batch_size=batch_size)
+        personal_circle = dict(Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner_id__in=parents).values_list('owner_id', 'id'))
+
+        membership_list = []
+        network = {}
+        for owner_id in parents:
+            neighbors = by_area[user_area[owner_id]]
+            members = set(rnd.sample(neighbors, min(len(neighbors), sample_degree(rnd, degree, len(neighbors)))))
+            members.discard(owner_id)
+            network[owner_id] = list(members)
+            for member_id in members:
+                membership_list.append(Membership(circle_id=personal_circle[owner_id], member_id=member_id, as_role=user_role[member_id], active=True,
+                                                  approved=rnd.random() < 0.9, as_admin=rnd.random() < 0.05, strength=round(rnd.random(), 2)))
+
+        # public circles, with members joining by popularity.
+        Circle.objects.bulk_create([Circle(name='%s:public:%d:%d' % (prefix, area_id, i), type=Circle.Type.PUBLIC.value, owner_id=rnd.choice(by_area[area_id]), area_id=area_id)
+                                    for area_id in area_ids for i in range(public_circles) if by_area[area_id]], batch_size=batch_size)
+        for circle_id, area_id in Circle.objects.filter(type=Circle.Type.PUBLIC.value, name__startswith='%s:public:' % prefix).values_list('id', 'area_id'):
+            neighbors = by_area[area_id]
+            for member_id in rnd.sample(neighbors, min(len(neighbors), sample_degree(rnd, group_size, len(neighbors)))):
+                membership_list.append(Membership(circle_id=circle_id, member_id=member_id, as_role=user_role[member_id], active=True, approved=True))
+        Membership.objects.bulk_create(membership_list, batch_size=batch_size)
+        counts['memberships'] = len(membership_list)
+
+        # contracts posted by the parents, matched with their network.
+        status_weights = [(Contract.Status.ACTIVE.value, 3), (Contract.Status.CONFIRMED.value, 2), (Contract.Status.SUCCESSFUL.value, 4), (Contract.Status.CANCELED.value, 1), (Contract.Status.EXPIRED.value, 1)]
+        status_choices = [status for status, weight in status_weights for i in range(weight)]
+        contract_list = []
+        for owner_id in parents:
+            for i in range(contracts_per_user):
+                start = now + timedelta(days=rnd.randint(-60, 30), hours=rnd.randint(8, 20))
+                contract_list.append(Contract(initiate_user_id=owner_id, area_id=user_area[owner_id], event_start=start, event_end=start + timedelta(hours=rnd.randint(1, 4)),
+                                              price=Decimal(rnd.choice((0, 0, 20, 40))), status=rnd.choice(status_choices)))
+        Contract.objects.bulk_create(contract_list, batch_size=batch_size)
+        contracts = list(Contract.objects.filter(initiate_user__username__startswith=prefix).values_list('id', 'initiate_user_id', 'status'))
+        counts['contracts'] = len(contracts)
+
+        match_list = []
+        for contract_id, owner_id, status in contracts:
+            for target_id in rnd.sample(network[owner_id], min(len(network[owner_id]), matches_per_contract)):
+                match_list.append(Match(contract_id=contract_id, target_user_id=target_id, status=rnd.choice((Match.Status.ENGAGED.value, Match.Status.ACCEPTED.value, Match.Status.DECLINED.value))))
+        Match.objects.bulk_create(match_list, batch_size=batch_size)
+        counts['matches'] = len(match_list)
+
+        # confirm an accepted match for confirmed/successful contracts.
+        confirmed_status = (Contract.Status.CONFIRMED.value, Contract.Status.SUCCESSFUL.value)
+        for contract_id, match_id in Match.objects.filter(contract__initiate_user__username__startswith=prefix, contract__status__in=confirmed_status, status=Match.Status.ACCEPTED.value).order_by('contract_id', 'id').values_list('contract_id', 'id'):
+            Contract.objects.filter(pk=contract_id, confirmed_match__isnull=True).update(confirmed_match=match_id)
+        Contract.objects.filter(initiate_user__username__startswith=prefix, status__in=confirmed_status, confirmed_match__isnull=True).update(status=Contract.Status.ACTIVE.value)
+
+    InteractionStats.rebuild()
+    logging.info('Synthetic network created: %s' % counts)
+    return counts
+
+
+def refresh_extended(prefix='synthetic'):
+    from circle.models import Circle, ExtendedNetwork
+    qs = Circle.objects.filter(type=Circle.Type.PERSONAL.value, owner__username__startswith=prefix).values_list('owner_id', 'area_id').distinct()
+    for owner_id, area_id in qs:
+        ExtendedNetwork.refresh(owner_id, area_id)
+
+
+def clear(prefix='synthetic'):
+    from puser.models import Area
+    from contract.models import Contract, InteractionStats
+    with transaction.atomic():
+        Contract.objects.filter(initiate_user__username__startswith=prefix).update(confirmed_match=None)
+        Contract.objects.filter(initiate_user__username__startswith=prefix).delete()
+        User.objects.filter(username__startswith=prefix).delete()
+        Area.objects.filter(name__startswith='%s ' % prefix).delete()
+    InteractionStats.rebuild()
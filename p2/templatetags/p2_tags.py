@@ -27,8 +27,15 @@ def bootstrap_alert(message):
 @register.simple_tag(takes_context=True)
 def user_picture_url(context, puser, **kwargs):
     assert isinstance(puser, User), 'Wrong type: %s' % type(puser)
-    puser = PUser.from_user(puser)
+    return compute_user_picture_url(PUser.from_user(puser), context, **kwargs)
+
+
+def compute_user_picture_url(puser, context=None, **kwargs):
     if puser.has_picture():
+        # no image work on the request once the thumbnail is generated in background (see puser.tasks).
+        # until then, e.g. before the generate_picture_thumbnails backfill ran, crop on the request as before.
+        if not kwargs and puser.info.picture_thumbnail:
+            return puser.info.picture_thumbnail
         try:
             return cropped_thumbnail(context, puser.info, 'picture_cropping',upscale=True, **kwargs)
         except Exception as e:
@@ -1,7 +1,16 @@
 # Create your tests here.
-from django.test import SimpleTestCase
+import json
+import os
+from decimal import Decimal
 
-from p2.utils import RelationshipType
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from p2 import synthetic
+from p2.celery import ModelTask
+from p2.profiling import profiler
+from p2.utils import RelationshipType, TestEnvMixin
+from puser.models import PUser
 
 
 class TestUtils(SimpleTestCase):
@@ -15,3 +24,102 @@ class TestUtils(SimpleTestCase):
 
         self.assertEqual('5,1', RelationshipType.to_db([RelationshipType.FRIEND, RelationshipType.DIRECT_FAMILY]))
         self.assertEqual([RelationshipType.FRIEND, RelationshipType.DIRECT_FAMILY], RelationshipType.from_db('5,1'))
+
+
+class TestModelTask(TestEnvMixin, TestCase):
+
+    def test_dehydrate(self):
+        task = ModelTask()
+        u = PUser.get_by_email('test@servuno.com')
+        args = (u, {'users': [u], 'when': timezone.now(), 'price': Decimal('1.50'), 'note': 'hi'})
+        message = json.loads(json.dumps(task.dehydrate(args)))
+        self.assertEqual(['puser', 'puser', u.pk], message[0]['__model__'])
+        restored = task.rehydrate(message)
+        self.assertEqual(u, restored[0])
+        self.assertIsInstance(restored[0], PUser)
+        self.assertEqual(args[1], restored[1])
+
+    def test_rehydrate_bulk(self):
+        task = ModelTask()
+        users = [PUser.get_by_email('test%s@servuno.com' % s) for s in ('', '1', '2')]
+        message = json.loads(json.dumps(task.dehydrate((users, {'user': users[0]}))))
+        # one query for all the references to the same model.
+        with self.assertNumQueries(1):
+            restored = task.rehydrate(message)
+        self.assertEqual(users, restored[0])
+        self.assertEqual(users[0], restored[1]['user'])
+        with self.assertRaises(ValueError):
+            task.dehydrate([PUser()])
+
+    def test_deleted_instance(self):
+        calls = []
+
+        class RecordTask(ModelTask):
+            name = 'p2.tests.record'
+
+            def run(self, *args):
+                calls.append(args)
+
+        task = RecordTask()
+        u = PUser.get_by_email('test3@servuno.com')
+        message = json.loads(json.dumps(task.dehydrate((u,))))
+        u.delete()
+        self.assertIsNone(task(*message))
+        self.assertEqual([], calls)
+
+
+class TestSynthetic(TestEnvMixin, TestCase):
+
+    def test_generate(self):
+        from circle.models import Membership
+        from contract.models import Contract
+        counts = synthetic.generate(users=50, degree=5, public_circles=2, group_size=10)
+        self.assertEqual(50, PUser.objects.filter(username__startswith='synthetic').count())
+        self.assertEqual(counts['memberships'], Membership.objects.filter(member__username__startswith='synthetic').count())
+        contracts = Contract.objects.filter(initiate_user__username__startswith='synthetic')
+        self.assertEqual(counts['contracts'], contracts.count())
+        for contract in contracts:
+            # the recommenders parse audience_data as JSON.
+            self.assertEqual('', contract.audience_data)
+            if contract.status == Contract.Status.SUCCESSFUL.value:
+                self.assertIsNotNone(contract.confirmed_match_id)
+        synthetic.clear()
+        self.assertFalse(PUser.objects.filter(username__startswith='synthetic').exists())
+        # a fresh queryset: "contracts" has cached its results in the loop above.
+        self.assertFalse(Contract.objects.filter(initiate_user__username__startswith='synthetic').exists())
+
+
+    def test_recommend(self):
+        # the bench command runs the production recommender on the synthetic contracts.
+        from contract.algorithms import ExtendedNetworkRecommender
+        from contract.models import Contract
+        synthetic.generate(users=30, degree=5, public_circles=1, group_size=10)
+        synthetic.refresh_extended()
+        contract = Contract.objects.filter(initiate_user__username__startswith='synthetic', status=Contract.Status.ACTIVE.value).first()
+        self.assertIsNotNone(contract)
+        ExtendedNetworkRecommender(contract).recommend()
+
+
+class TestProfiler(TestEnvMixin, TestCase):
+
+    def test_record(self):
+        u = PUser.get_by_email('test@servuno.com')
+        profiler.start('view', 'test')
+        PUser.objects.get(pk=u.id)
+        u.engagement_headline()
+        u.engagement_headline()
+        record = profiler.stop(role='test')
+        self.assertGreaterEqual(record.queries, 1)
+        self.assertEqual(1, record.cache_hits)
+        stats = [s for s in profiler.snapshot() if s['name'] == 'test']
+        self.assertEqual(1, stats[0]['count'])
+        self.assertIn(str(os.getpid()), ''.join(profiler.collect()))
+        profiler.reset()
+
+    def test_role_not_counted(self):
+        profiler.start('view', 'test')
+        PUser.objects.count()
+        record = profiler.stop(role=lambda: str(PUser.objects.count()))
+        self.assertEqual(1, record.queries)
+        self.assertEqual(str(PUser.objects.count()), record.role)
+        profiler.reset()
@@ -27,6 +27,7 @@ urlpatterns = patterns(
     url(r'^admin/', include(admin.site.urls)),
     url(r'^experiment/$', views.ExperimentView.as_view(), name='experiment'),
     url(r'^logo/$', views.LogoView.as_view(), name='logo'),
+    url(r'^profiling/$', views.profiling_stats, name='profiling'),
     # url(r'^error/$', views.ErrorView.as_view(), name='error'),
 
     # note: the following thing about static is only valid in dev.
@@ -217,6 +217,14 @@ class TestEnvMixin(object):
     fixtures = ['area.json', 'signup_code.json', 'sites.json']
 
     def setUp(self):
+        # the social graph index and the system identity live in memory and do not know about rolled back test transactions.
+        # the cache is a locmem cache while testing (see the test overrides in p2.settings).
+        from circle.graph import social_graph
+        from django.core.cache import cache
+        from shout.notify import system_identity
+        social_graph.clear()
+        system_identity.invalidate()
+        cache.clear()
         recreate_test_env()
 
 
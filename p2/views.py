@@ -1,7 +1,9 @@
 from collections import defaultdict
 
 from braces.views import LoginRequiredMixin
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.urlresolvers import reverse
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from account.forms import LoginEmailForm
 from django.views.generic import TemplateView
@@ -9,9 +11,15 @@ from circle.models import Membership, Circle
 from contract.models import Contract
 
 from puser.forms import WaitingForm
+from p2.profiling import profiler
 from puser.models import MenuItem
 
 
+@staff_member_required
+def profiling_stats(request):
+    return JsonResponse(profiler.collect())
+
+
 def home(request):
     if request.user.is_anonymous():
         return redirect(reverse('landing'))
@@ -0,0 +1,41 @@
+import threading
+
+
+class IdentityMap(object):
+    """
+    Request/task scoped map of user id => PUser, so that the Info of each distinct user is loaded at most once.
+    PUser.from_user() registers each user here, and copies the Info already loaded for another instance of the same user.
+    Active between begin() and end(), which are called by PUserMiddleware and the celery task signals. Does nothing otherwise.
+    begin()/end() nest, e.g. for a task run eagerly inside a request: the map is kept until the outermost end().
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self):
+        depth = getattr(self.local, 'depth', 0)
+        if depth == 0:
+            self.local.users = {}
+        self.local.depth = depth + 1
+
+    def end(self):
+        depth = getattr(self.local, 'depth', 0) - 1
+        if depth <= 0:
+            depth, self.local.users = 0, None
+        self.local.depth = depth
+
+    def add(self, puser):
+        users = getattr(self.local, 'users', None)
+        if users is None or puser.pk is None:
+            return puser
+        from puser.models import PUser
+        cache_name = PUser.info.cache_name
+        known = users.get(puser.pk, None)
+        if known is not None and known is not puser and hasattr(known, cache_name) and not hasattr(puser, cache_name):
+            setattr(puser, cache_name, getattr(known, cache_name))
+        if known is None or hasattr(puser, cache_name):
+            users[puser.pk] = puser
+        return puser
+
+
+identity_map = IdentityMap()
@@ -1,15 +1,27 @@
 from django.utils.functional import SimpleLazyObject
 
+from puser.identity import identity_map
 from puser.models import PUser
 
 
+def get_puser(request):
+    # request.user is a lazy object; assigning the class goes through to the user loaded by AuthenticationMiddleware,
+    # so request.user and request.puser are the same instance.
+    return PUser.from_user(request.user)
+
+
 class PUserMiddleware(object):
     """
-    Add puser to all request.
+    Add puser to all request, and keep the user identity map for the request.
     """
 
     def process_request(self, request):
+        identity_map.begin()
         if hasattr(request, 'user'):
-            request.puser = SimpleLazyObject(lambda: PUser.from_user(request.user))
+            request.puser = SimpleLazyObject(lambda: get_puser(request))
             # request.puser = PUser.from_user(request.user)
             # timezone.activate(request.puser.get_timezone())
+
+    def process_response(self, request, response):
+        identity_map.end()
+        return response
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_favor_count(apps, schema_editor):
+    Info = apps.get_model('puser', 'Info')
+    InteractionStats = apps.get_model('contract', 'InteractionStats')
+    for server_id, total in InteractionStats.objects.values_list('server_id').annotate(total=models.Sum('served')):
+        Info.objects.filter(user_id=server_id).update(favor_count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0005_interactionstats'),
+        ('puser', '0003_info_private_note'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='info',
+            name='favor_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_favor_count, migrations.RunPython.noop),
+    ]
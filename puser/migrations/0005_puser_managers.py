@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import puser.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puser', '0004_info_favor_count'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='puser',
+            managers=[
+                ('objects', puser.models.PUserManager()),
+            ],
+        ),
+    ]
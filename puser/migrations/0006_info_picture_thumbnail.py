@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puser', '0005_puser_managers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='info',
+            name='picture_thumbnail',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('puser', '0006_info_picture_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='info',
+            name='favor_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
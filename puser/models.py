@@ -4,22 +4,28 @@ import pytz
 from account.models import Account, EmailAddress
 from account.signals import password_changed
 from account.views import PasswordResetTokenView
-from django.contrib.auth.models import User, AbstractUser
+from django.contrib.auth.models import User, AbstractUser, UserManager
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import Q, F
+from django.db.models import Q, F, Prefetch
+from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from image_cropping import ImageCropField, ImageRatioField
+from image_cropping.templatetags.cropping import cropped_thumbnail
 from localflavor.us.models import PhoneNumberField, USStateField
 from django.conf import settings
 from sitetree.models import TreeItemBase
 
 from circle.models import Membership, Circle, UserConnection
-from contract.models import Contract, Match, Engagement
-from login_token.models import Token
+from contract.models import Contract, Match, Engagement, InteractionStats
+from login_token.models import RevokedToken, Token
+from login_token.signed import make_signed_token
+from p2.cache import user_cache
 from p2.utils import auto_user_name, UserRole, TrustedMixin, TrustLevel
+from puser import tasks
+from puser.identity import identity_map
 
 
 # move this to management instead
@@ -77,6 +83,8 @@ class Info(models.Model):
 
     picture_original = ImageCropField(upload_to='picture', blank=True, null=True)
     picture_cropping = ImageRatioField('picture_original', '200x200')
+    # url of the cropped thumbnail, generated in background by puser.tasks.generate_picture_thumbnail after upload.
+    picture_thumbnail = models.CharField(max_length=255, blank=True)
 
     # user's home area. it doesn't necessarily mean the user will request/respond to this area only.
     area = models.ForeignKey(Area, default=1)
@@ -84,6 +92,10 @@ class Info(models.Model):
     # whether this user is pre-registered, or registered.
     registered = models.BooleanField(default=True)
 
+    # how many times this user has served others in successful contracts. kept in sync by contract.InteractionStats.
+    # signed, so that decrementing with F() can't fail on a drifted count. read it through PUser.count_favors_all().
+    favor_count = models.IntegerField(default=0)
+
     # these are site preferences
     role = models.PositiveSmallIntegerField(choices=[(t.value, t.name.capitalize()) for t in UserRole], blank=True, null=True)
     enable_sms = models.BooleanField(default=False, help_text='Whether to receive SMS for important notifications.')
@@ -96,6 +108,17 @@ class Info(models.Model):
     def __str__(self):
         return self.user.get_full_name() or self.user.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # remember the picture as loaded, so that saving can tell whether the thumbnail is out of date without a query.
+        instance = super(Info, cls).from_db(db, field_names, values)
+        if 'picture_original' in field_names and 'picture_cropping' in field_names:
+            instance._loaded_picture = instance.picture_key()
+        return instance
+
+    def picture_key(self):
+        return self.picture_original.name or '', self.picture_cropping or ''
+
     def set_area(self, area):
         # todo: there might be more stuff to do later (e.g., change list location)
         self.area = area
@@ -106,6 +129,30 @@ class Info(models.Model):
         info, created = Info.objects.get_or_create(user=user)
         return info
 
+    def generate_thumbnail(self):
+        """
+        Generate the cropped thumbnail of the picture (if not generated yet), and return its url. This does the image work.
+        """
+        return cropped_thumbnail(None, self, 'picture_cropping', upscale=True)
+
+
+class PUserQuerySet(models.QuerySet):
+
+    def with_profile(self):
+        """
+        Load the info together with the users. For users reached through other objects, use PUser.preload_profiles().
+        """
+        return self.select_related('info')
+
+
+class PUserManager(UserManager):
+
+    def get_queryset(self):
+        return PUserQuerySet(self.model, using=self._db)
+
+    def with_profile(self):
+        return self.get_queryset().with_profile()
+
 
 # class PUser(AbstractUser):
 class PUser(TrustedMixin, User):
@@ -113,6 +160,8 @@ class PUser(TrustedMixin, User):
     This is the proxy class for User instead of using monkey patch.
     """
 
+    objects = PUserManager()
+
     class Meta():
         proxy = True
         # db_table = 'auth_user'
@@ -133,11 +182,11 @@ class PUser(TrustedMixin, User):
 
     @staticmethod
     def from_user(user):
+        # PUser is a proxy, so the loaded User is converted in place without a query, the same way as Circle.to_proxy().
         assert isinstance(user, User)
-        if isinstance(user, PUser):
-            return user
-        else:
-            return PUser.objects.get(pk=user.id)
+        if not isinstance(user, PUser):
+            user.__class__ = PUser
+        return identity_map.add(user)
 
     def has_area(self):
         try:
@@ -171,10 +220,19 @@ class PUser(TrustedMixin, User):
     def get_personal_circle(self, area=None):
         if area is None:
             area = self.get_area()
-        circle, created = Circle.objects.get_or_create(type=Circle.Type.PERSONAL.value, owner=self, area=area, defaults={
-            'name': '%s:personal:%d' % (self.username, area.id)
-        })
-        return circle
+
+        def compute():
+            circle, created = Circle.objects.get_or_create(type=Circle.Type.PERSONAL.value, owner=self, area=area, defaults={
+                'name': '%s:personal:%d' % (self.username, area.id)
+            })
+            return circle.id
+        # only the id is cached: callers get a fresh row, which is safe to change and save.
+        circle_id = user_cache.get_or_set('personal_circle', self.id, compute, suffix=':%d' % area.id)
+        try:
+            return Circle.objects.get(pk=circle_id)
+        except Circle.DoesNotExist:
+            user_cache.invalidate([self.id])
+            return Circle.objects.get(pk=compute())
 
     def my_circle(self, type, area=None):
         """
@@ -276,6 +334,20 @@ class PUser(TrustedMixin, User):
     def has_picture(self):
         return self.has_info() and self.info.picture_original
 
+    @staticmethod
+    def preload_profiles(users):
+        """
+        Load the info of the users in one query, unless select_related already did. The user_picture_url tag then renders without queries.
+        """
+        cache_name = PUser.info.cache_name
+        missing = {u.id for u in users if not hasattr(u, cache_name)}
+        if missing:
+            info_map = Info.objects.in_bulk(missing)
+            for u in users:
+                if u.id in missing:
+                    # None makes "info" raise DoesNotExist without a query.
+                    setattr(u, cache_name, info_map.get(u.id, None))
+
     def picture_link(self):
         from p2.templatetags.p2_tags import user_picture_url
         return user_picture_url(None, self)
@@ -300,16 +372,17 @@ class PUser(TrustedMixin, User):
         return Contract.objects.filter(Q(initiate_user=self) | Q(match__target_user=self)).distinct()
 
     def engagement_list(self, extra_query=lambda qs: qs):
+        # one query for the contracts with their users, and one for my own matches in those contracts.
+        my_matches = Prefetch('match_set', queryset=Match.objects.filter(target_user=self), to_attr='my_matches')
+        qs = self.engagement_queryset().select_related('initiate_user', 'confirmed_match__target_user').prefetch_related(my_matches)
         list_engagement = []
-        for contract in extra_query(self.engagement_queryset()):
-            if contract.initiate_user == self:
+        for contract in extra_query(qs):
+            if contract.initiate_user_id == self.id:
                 list_engagement.append(Engagement.from_contract(contract))
-            else:
-                try:
-                    match = Match.objects.get(contract=contract, target_user=self)
-                    list_engagement.append(Engagement.from_match(match))
-                except:
-                    continue
+            elif contract.my_matches:
+                match = contract.my_matches[0]
+                match.contract, match.target_user = contract, self
+                list_engagement.append(Engagement.from_match(match))
         return list_engagement
 
     def engagement_headline(self):
@@ -319,20 +392,12 @@ class PUser(TrustedMixin, User):
         # 2. if i'm the server, then show when i'm confirmed or i haven't responded.
         # use "id" as the 2nd "order by" for consistent ordering.
 
-        # cache it in template
-        # engagement = cache.get('user_engagement')
-        # if engagement is not None:
-        #     return engagement
-
-        engagement_list = self.engagement_list(lambda qs: qs.filter((Q(initiate_user=self) & Q(status__in=(Contract.Status.INITIATED.value, Contract.Status.ACTIVE.value, Contract.Status.CONFIRMED.value))) | (Q(match__target_user=self) & (Q(match__status__in=(Match.Status.ENGAGED.value,)) | Q(match=F('confirmed_match'))))).filter(event_start__gt=timezone.now(), event_end__lt=timezone.now() + timedelta(days=60)).order_by('event_start', 'id')[:1])
-        if engagement_list:
-            engagement = engagement_list[0]
-            # in cache for 5 minutes
-            # cache.set('user_engagement', engagement, 300)
-            return engagement
-        else:
+        # cached, and invalidated when my contracts/matches change. see p2.cache.
+        def compute():
+            engagement_list = self.engagement_list(lambda qs: qs.filter((Q(initiate_user=self) & Q(status__in=(Contract.Status.INITIATED.value, Contract.Status.ACTIVE.value, Contract.Status.CONFIRMED.value))) | (Q(match__target_user=self) & (Q(match__status__in=(Match.Status.ENGAGED.value,)) | Q(match=F('confirmed_match'))))).filter(event_start__gt=timezone.now(), event_end__lt=timezone.now() + timedelta(days=60)).order_by('event_start', 'id')[:1])
             # if not found, then return None
-            return None
+            return engagement_list[0] if engagement_list else None
+        return user_cache.get_or_set('headline', self.id, compute)
 
     def engagement_favors(self):
         results = []
@@ -351,18 +416,14 @@ class PUser(TrustedMixin, User):
         Count how many times the current puser (as "server") has served the client.
         """
         assert isinstance(client, User)     # PUser is also an instance of user.
-        return Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value).filter(Q(confirmed_match__target_user=self, initiate_user=client, reversed=False) | Q(initiate_user=self, confirmed_match__target_user=client, reversed=True)).count()
+        return InteractionStats.lookup(self.id, client.id)[0]
 
     def count_favors(self, client):
         """
         Count how many times the current puser (as "server") has served the client as favors.
         """
         assert isinstance(client, User)     # PUser is also an instance of user.
-        count = 0
-        for contract in Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value).filter(Q(confirmed_match__target_user=self, initiate_user=client, reversed=False) | Q(initiate_user=self, confirmed_match__target_user=client, reversed=True)):
-            if contract.is_favor():
-                count += 1
-        return count
+        return InteractionStats.lookup(self.id, client.id)[1]
 
     def count_favors_all(self):
         # count = 0
@@ -371,13 +432,31 @@ class PUser(TrustedMixin, User):
         #         count += 1
 
         # TODO: this need to think thru. for a parent (not sitter), even paid job could be a favor.
-        return Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value).filter(Q(confirmed_match__target_user=self, reversed=False) | Q(initiate_user=self, reversed=True)).count()
+        return max(0, self.info.favor_count) if self.has_info() else 0
 
     def count_interactions(self, target_user):
-        return Contract.objects.filter(status=Contract.Status.SUCCESSFUL.value).filter(Q(confirmed_match__target_user=self, initiate_user=target_user) | Q(initiate_user=self, confirmed_match__target_user=target_user)).count()
+        return InteractionStats.lookup(self.id, target_user.id)[0] + InteractionStats.lookup(target_user.id, self.id)[0]
 
     def get_level(self):
-        count = self.count_favors_all()
+        return user_cache.get_or_set('level', self.id, lambda: PUser.level_from_count(self.count_favors_all()))
+
+    @staticmethod
+    def levels_for(user_ids):
+        """
+        Levels of many users, e.g. for a list of users, returned as {user_id: level}. Shares the cache with get_level(),
+        and the users not cached are loaded with one query.
+        """
+        levels = user_cache.get_many('level', user_ids)
+        missing = [user_id for user_id in user_ids if user_id not in levels]
+        if missing:
+            counts = dict(Info.objects.filter(user_id__in=missing).values_list('user_id', 'favor_count'))
+            computed = {user_id: PUser.level_from_count(max(0, counts.get(user_id, 0))) for user_id in missing}
+            user_cache.set_many('level', computed)
+            levels.update(computed)
+        return levels
+
+    @staticmethod
+    def level_from_count(count):
         levels = [
             (0, 0, 'Unborn Angel'),
             (1, 1, 'Infant Angel'),
@@ -401,6 +480,9 @@ class PUser(TrustedMixin, User):
         }
 
     def get_login_token(self, force=False):
+        # signed tokens don't need a Token row, which saves a write per notification.
+        if force and settings.LOGIN_TOKEN_SIGNED:
+            return make_signed_token(self)
         try:
             token = self.token
             return token.token
@@ -492,6 +574,31 @@ def verify_email_after_password_reset(sender, user, **kwargs):
     EmailAddress.objects.filter(user=user, email=user.email, verified=False).update(verified=True)
 
 
+@receiver(password_changed)
+def revoke_signed_tokens_after_password_change(sender, user, **kwargs):
+    # login links sent before the password change stop working. deactivated users are refused by the auth backend anyway.
+    RevokedToken.revoke(user)
+
+
+@receiver(pre_save, sender=Info)
+def info_reset_picture_thumbnail(sender, instance, **kwargs):
+    # the thumbnail is out of date when the picture or the cropping changed since loaded. instances not loaded from the db
+    # (new ones, or with deferred picture fields) count as changed if they have a picture.
+    loaded = getattr(instance, '_loaded_picture', None)
+    current = instance.picture_key()
+    instance._picture_changed = current != loaded if loaded is not None else bool(current[0])
+    if instance._picture_changed:
+        instance.picture_thumbnail = ''
+
+
+@receiver(post_save, sender=Info)
+def info_generate_picture_thumbnail(sender, **kwargs):
+    instance = kwargs['instance']
+    if getattr(instance, '_picture_changed', False) and instance.picture_original:
+        tasks.generate_picture_thumbnail.delay(instance.user_id)
+    instance._loaded_picture = instance.picture_key()
+
+
 class MenuItem(TreeItemBase):
     fa_icon = models.CharField(help_text='Font awesome icon', blank=True, max_length=50)
     # css_id = models.CharField(help_text='CSS ID', blank=True, max_length=50)
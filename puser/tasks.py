@@ -0,0 +1,16 @@
+from celery import shared_task
+
+
+@shared_task
+def generate_picture_thumbnail(user_id):
+    """
+    Generate the cropped thumbnail of the user picture, and store its url in Info.picture_thumbnail.
+    The url is stored only if the picture hasn't changed in the meantime.
+    """
+    from puser.models import Info
+    info = Info.objects.filter(user_id=user_id).first()
+    if info is None or not info.picture_original:
+        return None
+    url = info.generate_thumbnail()
+    Info.objects.filter(user_id=user_id, picture_original=info.picture_original.name, picture_cropping=info.picture_cropping).update(picture_thumbnail=url)
+    return url
@@ -1,7 +1,23 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from account.signals import password_changed
+from account.views import ChangePasswordView
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
 from django.test import TestCase
+from django.utils import timezone
 
+from contract.models import Contract
+from login_token.signed import make_signed_token
+from p2.templatetags.p2_tags import compute_user_picture_url
 from p2.utils import TestEnvMixin
-from puser.models import PUser
+from puser import tasks
+from puser.identity import identity_map
+from puser.models import Info, PUser
 
 
 class PUserTest(TestEnvMixin, TestCase):
@@ -11,4 +27,141 @@ class PUserTest(TestEnvMixin, TestCase):
         u2 = PUser.get_by_email('test2@servuno.com')
         self.assertTrue(u.is_user_trusted(u1))
         self.assertTrue(u1.is_user_trusted(u))
-        self.assertFalse(u1.is_user_trusted(u2))
\ No newline at end of file
+        self.assertFalse(u1.is_user_trusted(u2))
+
+    def test_from_user(self):
+        user = User.objects.get(email='test@servuno.com')
+        with self.assertNumQueries(0):
+            puser = PUser.from_user(user)
+        self.assertIs(user, puser)
+        self.assertEqual(PUser.get_by_email('test@servuno.com').get_area(), puser.get_area())
+        # another instance of the same user shares the loaded info within the identity map.
+        identity_map.begin()
+        try:
+            PUser.from_user(puser)
+            other = PUser.from_user(User.objects.get(email='test@servuno.com'))
+            with self.assertNumQueries(0):
+                self.assertEqual(puser.info.area_id, other.info.area_id)
+        finally:
+            identity_map.end()
+
+    def test_identity_map_nested(self):
+        identity_map.begin()
+        try:
+            puser = PUser.from_user(User.objects.get(email='test@servuno.com'))
+            puser.info
+            # e.g. a task run eagerly within the request.
+            identity_map.begin()
+            identity_map.end()
+            other = PUser.from_user(User.objects.get(email='test@servuno.com'))
+            with self.assertNumQueries(0):
+                other.info
+        finally:
+            identity_map.end()
+        self.assertIsNone(identity_map.local.users)
+
+    def test_get_puser(self):
+        from django.utils.functional import SimpleLazyObject
+        from puser.middleware import get_puser
+        request = type('Request', (object, ), {})()
+        request.user = SimpleLazyObject(lambda: User.objects.get(email='test@servuno.com'))
+        puser = get_puser(request)
+        self.assertIsInstance(puser, PUser)
+        self.assertIsInstance(request.user, PUser)
+        self.assertEqual(PUser.get_by_email('test@servuno.com').get_area(), puser.get_area())
+
+    def test_with_profile(self):
+        from p2.templatetags.p2_tags import user_picture_url
+        users = list(PUser.objects.with_profile().filter(email__endswith='@servuno.com'))
+        self.assertTrue(users)
+        with self.assertNumQueries(0):
+            urls = [user_picture_url(None, u) for u in users]
+        self.assertEqual([user_picture_url(None, PUser.objects.get(pk=u.id)) for u in users], urls)
+        # users reached through other objects.
+        users = [PUser.objects.get(pk=u.id) for u in users]
+        PUser.preload_profiles(users)
+        with self.assertNumQueries(0):
+            self.assertEqual(urls, [user_picture_url(None, u) for u in users])
+
+    def test_headline_cache(self):
+        u = PUser.get_by_email('test@servuno.com')
+        self.assertIsNone(u.engagement_headline())
+        start = timezone.now() + timedelta(days=1)
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=start, event_end=start + timedelta(hours=2))
+        # saving the contract drops the cached headline.
+        self.assertEqual(contract, u.engagement_headline().contract)
+
+    def test_personal_circle_cache(self):
+        u = PUser.get_by_email('test@servuno.com')
+        circle = u.get_personal_circle()
+        # the cached circle is loaded fresh each time, so changes made through another instance are not lost.
+        other = u.get_personal_circle()
+        self.assertEqual(circle, other)
+        self.assertIsNot(circle, other)
+        circle.name = 'changed'
+        circle.save()
+        self.assertEqual('changed', u.get_personal_circle().name)
+
+    def test_picture_thumbnail(self):
+        from io import BytesIO
+        from PIL import Image
+        # image_cropping reads the picture when saving, so write a real one to a temporary MEDIA_ROOT.
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        picture = BytesIO()
+        Image.new('RGB', (300, 300), 'white').save(picture, 'PNG')
+
+        u = PUser.get_by_email('test@servuno.com')
+        info = Info.objects.get(user=u)
+        info.picture_original.save('test.png', ContentFile(picture.getvalue()), save=False)
+        with mock.patch.object(tasks.generate_picture_thumbnail, 'delay') as delay:
+            info.save()
+        delay.assert_called_once_with(u.id)
+
+        # until the thumbnail is generated, the picture is cropped on the request, not served in full size.
+        with mock.patch('p2.templatetags.p2_tags.cropped_thumbnail', return_value='/media/cropped.png'):
+            self.assertEqual('/media/cropped.png', compute_user_picture_url(PUser.objects.get(pk=u.id)))
+
+        with mock.patch.object(Info, 'generate_thumbnail', return_value='/media/thumbnail.png'):
+            self.assertEqual('/media/thumbnail.png', tasks.generate_picture_thumbnail(u.id))
+        self.assertIsNone(tasks.generate_picture_thumbnail(PUser.get_by_email('test1@servuno.com').id))
+        self.assertEqual('/media/thumbnail.png', compute_user_picture_url(PUser.objects.get(pk=u.id)))
+
+        # saving other fields keeps the thumbnail, without looking up the old picture.
+        info = Info.objects.get(user=u)
+        info.note = 'changed'
+        with mock.patch.object(tasks.generate_picture_thumbnail, 'delay') as delay, self.assertNumQueries(1):
+            info.save()
+        self.assertFalse(delay.called)
+        self.assertEqual('/media/thumbnail.png', Info.objects.get(user=u).picture_thumbnail)
+
+        # changing the cropping resets the thumbnail and generates it again.
+        info.picture_cropping = '0,0,100,100'
+        with mock.patch.object(tasks.generate_picture_thumbnail, 'delay') as delay:
+            info.save()
+        delay.assert_called_once_with(u.id)
+        self.assertEqual('', Info.objects.get(user=u).picture_thumbnail)
+
+    def test_password_change_revokes_signed_token(self):
+        u = PUser.get_by_email('test@servuno.com')
+        token = make_signed_token(u)
+        self.assertEqual(u.id, authenticate(token=token).id)
+        password_changed.send(sender=ChangePasswordView, user=u)
+        self.assertIsNone(authenticate(token=token))
+
+    def test_engagement_list(self):
+        u = PUser.get_by_email('test@servuno.com')
+        u1 = PUser.get_by_email('test1@servuno.com')
+        start = timezone.now() + timedelta(days=1)
+        contract = Contract.objects.create(initiate_user=u, area=u.info.area, price=30, event_start=start, event_end=start + timedelta(hours=2))
+        contract.add_matches_bulk([u1])
+        # the fixture has contracts of test@ with test1@ matched, too.
+        expected = set(Contract.objects.filter(initiate_user=u, match__target_user=u1))
+        self.assertIn(contract, expected)
+        with self.assertNumQueries(2):
+            engagement_list = u1.engagement_list()
+            self.assertEqual(expected, {e.contract for e in engagement_list if e.contract.initiate_user == u})
+            self.assertTrue(all(e.match.target_user == u1 for e in engagement_list if e.initiate_user != u1))
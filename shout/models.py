@@ -2,10 +2,13 @@ from enum import Enum
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from circle.models import Circle
 from contract.models import Contract
-from shout.notify import notify_agent
+from puser.models import PUser
+from shout.notify import notify_agent, system_identity
 
 
 class Shout(models.Model):
@@ -49,3 +52,15 @@ class Shout(models.Model):
 
         self.delivered = True
         self.save()
+
+
+############################ signals ###############################
+
+
+# PUser is a proxy model, and signals are sent with the proxy class as sender.
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=PUser)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=PUser)
+def user_invalidate_system_identity(sender, **kwargs):
+    system_identity.invalidate(kwargs['instance'])
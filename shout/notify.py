@@ -1,10 +1,14 @@
+from contextlib import contextmanager
 from enum import Enum
+import logging
 import re
+import threading
+import time
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.mail import EmailMessage, get_connection
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 
 from django.conf import settings
 
@@ -12,6 +16,39 @@ from p2.utils import is_valid_email
 from puser.models import PUser
 
 
+class SystemIdentity(object):
+    """
+    The site admin user that system notifications are sent from/to, i.e. the user of settings.DEFAULT_FROM_EMAIL.
+    Resolved once per process and dropped when the user row changes (see the signals in shout.models).
+    The signals only reach the local process, so the user is also reloaded after settings.SYSTEM_IDENTITY_TTL seconds.
+    """
+
+    def __init__(self):
+        self.user = None
+        self.loaded = 0
+        email = settings.DEFAULT_FROM_EMAIL
+        matched = re.match(r'.+<(.+@.+)>', email)
+        self.email = matched.group(1) if matched else email
+
+    def get_user(self):
+        user = self.user
+        if user is None or time.time() - self.loaded >= settings.SYSTEM_IDENTITY_TTL:
+            try:
+                user = PUser.objects.get(email=self.email)
+            except PUser.DoesNotExist:
+                user = PUser.create(self.email, dummy=True)
+            self.user, self.loaded = user, time.time()
+        return user
+
+    def invalidate(self, user=None):
+        # only drop the cached user if the changed user is relevant.
+        if user is None or (self.user is not None and user.pk == self.user.pk) or user.email == self.email:
+            self.user = None
+
+
+system_identity = SystemIdentity()
+
+
 class Notify(object):
     """
     This is the "facade" for all notifications purposes. Potentially allow SMS.
@@ -23,26 +60,95 @@ class Notify(object):
         SMS = 2
         EMAIL_SMS = 3
 
+    def __init__(self):
+        # messages queued by batch(), per thread.
+        self.local = threading.local()
+        # compiled templates by name, and the site related part of default_context(). both live as long as the process.
+        self.templates = {}
+        self.site_context = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue messages from send() within the block, and deliver them when the block exits over one connection.
+        If the block raises (e.g. the transaction is rolled back), the queued messages are discarded. Nested blocks join the outer one.
+        """
+        if getattr(self.local, 'queue', None) is not None:
+            yield
+            return
+        self.local.queue = []
+        try:
+            yield
+        except:
+            self.local.queue = None
+            raise
+        messages_list, self.local.queue = self.local.queue, None
+        self.deliver(messages_list)
+
+    def deliver(self, messages_list):
+        """
+        Send messages over one connection, in batches of settings.NOTIFY_BATCH_SIZE and no faster than settings.NOTIFY_RATE_LIMIT per second.
+        """
+        if not messages_list:
+            return 0
+        count = 0
+        batch_size = settings.NOTIFY_BATCH_SIZE
+        connection = get_connection(fail_silently=True)       # use the default email settings
+        connection.open()
+        try:
+            for i in range(0, len(messages_list), batch_size):
+                batch = messages_list[i:i + batch_size]
+                start = time.time()
+                count += connection.send_messages(batch) or 0
+                elapsed = time.time() - start
+                logging.info('Notify batch: %d messages sent in %.3fs' % (len(batch), elapsed))
+                if settings.NOTIFY_RATE_LIMIT > 0 and i + batch_size < len(messages_list):
+                    time.sleep(max(0, len(batch) / settings.NOTIFY_RATE_LIMIT - elapsed))
+        finally:
+            connection.close()
+        return count
+
     def default_context(self):
-        current_site = Site.objects.get_current()
-        return {
-            'site_name': current_site.name,
-            'site_domain': current_site.domain,
-            'site_url': 'http://%s' % current_site.domain,
-            'current_site': current_site,
-            'DEBUG': settings.DEBUG,
-        }
+        if self.site_context is None:
+            current_site = Site.objects.get_current()
+            self.site_context = {
+                'site_name': current_site.name,
+                'site_domain': current_site.domain,
+                'site_url': 'http://%s' % current_site.domain,
+                'current_site': current_site,
+            }
+        context = dict(self.site_context)
+        context['DEBUG'] = settings.DEBUG
+        return context
+
+    def get_template(self, name):
+        # don't keep compiled templates in DEBUG, so that template changes show up right away.
+        if settings.DEBUG:
+            return get_template(name)
+        template = self.templates.get(name, None)
+        if template is None:
+            template = self.templates[name] = get_template(name)
+        return template
+
+    def render(self, tpl_prefix, context):
+        """
+        Render the subject and body of the notification templates. Returns (subject, body).
+        """
+        subject = self.get_template(tpl_prefix + '_subject.txt').render(context)
+        subject = ''.join(subject.splitlines())
+        body = self.get_template(tpl_prefix + '_body.txt').render(context)
+        return subject, body
+
+    def render_many(self, tpl_prefix, context_list):
+        """
+        Same as render() for many contexts at once; templates are looked up only once.
+        """
+        subject_tpl = self.get_template(tpl_prefix + '_subject.txt')
+        body_tpl = self.get_template(tpl_prefix + '_body.txt')
+        return [(''.join(subject_tpl.render(context).splitlines()), body_tpl.render(context)) for context in context_list]
 
     def get_site_admin_user(self):
-        email = settings.DEFAULT_FROM_EMAIL
-        matched = re.match(r'.+<(.+@.+)>', email)
-        if matched:
-            email = matched.group(1)
-        try:
-            puser = PUser.objects.get(email=email)
-            return puser
-        except PUser.DoesNotExist:
-            return PUser.create(email, dummy=True)
+        return system_identity.get_user()
 
     def send(self, from_user, to_user, tpl_prefix, ctx=None, anonymous=False, cc_user_list=[]):
         """
@@ -54,28 +160,19 @@ class Notify(object):
             to_user = self.get_site_admin_user()
         assert isinstance(from_user, User) and (isinstance(to_user, User) or all([isinstance(u, User) for u in to_user]))
 
-        subject_tpl = tpl_prefix + '_subject.txt'
-        body_tpl = tpl_prefix + '_body.txt'
-
-        context = self.default_context()
-        context['from_user'] = PUser.from_user(from_user)
-        if isinstance(to_user, User):
-            context['to_user'] = PUser.from_user(to_user)
-        else:
-            context['to_user'] = to_user
-        context['template_id'] = tpl_prefix
-        if ctx:
-            context.update(ctx)
-
-        subject = render_to_string(subject_tpl, context)
-        subject = ''.join(subject.splitlines())
-        body = render_to_string(body_tpl, context)
+        subject, body = self.render(tpl_prefix, self.get_context(from_user, to_user, tpl_prefix, ctx))
 
         if isinstance(to_user, User):
             to_user_list = [to_user]
         else:
             to_user_list = to_user
 
+        return self.dispatch(self.make_messages(from_user, to_user_list, subject, body, anonymous, cc_user_list))
+
+    def make_messages(self, from_user, to_user_list, subject, body, anonymous=False, cc_user_list=[]):
+        """
+        Build one email message for each user in to_user_list.
+        """
         cc_email_list = []
         for cc_user in cc_user_list:
             if isinstance(cc_user, User):
@@ -91,7 +188,41 @@ class Notify(object):
             else:
                 msg = EmailMessage(subject, body, from_email=settings.DEFAULT_FROM_EMAIL, to=[u.email], reply_to=[from_user.email], cc=cc_email_list)
             messages_list.append(msg)
+        return messages_list
+
+    def send_each(self, from_user, tpl_prefix, recipient_list, anonymous=False, cc_user_list=[]):
+        """
+        Send the same notification to many users, each with its own context: recipient_list is [(to_user, ctx)].
+        The templates are rendered in one pass and the messages are delivered together. anonymous and cc_user_list work as in send().
+        """
+        if from_user is None:
+            from_user = self.get_site_admin_user()
+        recipient_list = list(recipient_list)
+        rendered = self.render_many(tpl_prefix, [self.get_context(from_user, to_user, tpl_prefix, ctx) for to_user, ctx in recipient_list])
+        messages_list = []
+        for (to_user, ctx), (subject, body) in zip(recipient_list, rendered):
+            messages_list.extend(self.make_messages(from_user, [to_user], subject, body, anonymous, cc_user_list))
+        with self.batch():
+            return self.dispatch(messages_list)
+
+    def get_context(self, from_user, to_user, tpl_prefix, ctx=None):
+        context = self.default_context()
+        context['from_user'] = PUser.from_user(from_user)
+        if isinstance(to_user, User):
+            context['to_user'] = PUser.from_user(to_user)
+        else:
+            context['to_user'] = to_user
+        context['template_id'] = tpl_prefix
+        if ctx:
+            context.update(ctx)
+        return context
 
+    def dispatch(self, messages_list):
+        # queue the messages if within batch(), or send them right away.
+        queue = getattr(self.local, 'queue', None)
+        if queue is not None:
+            queue.extend(messages_list)
+            return len(messages_list)
         connection = get_connection(fail_silently=True)       # use the default email settings
         return connection.send_messages(messages_list)
 
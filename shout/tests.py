@@ -1 +1,64 @@
 # Create your tests here.
+from django.core import mail
+from django.test import TestCase
+
+from p2.utils import TestEnvMixin
+from puser.models import PUser
+from shout.notify import notify_agent
+
+
+class NotifyTest(TestEnvMixin, TestCase):
+
+    def test_batch(self):
+        u = PUser.get_by_email('test@servuno.com')
+        u2 = PUser.get_by_email('test2@servuno.com')
+        mail.outbox = []
+        with notify_agent.batch():
+            notify_agent.send(None, u, 'account/email/invite_instructions')
+            notify_agent.send(None, u2, 'account/email/invite_instructions')
+            self.assertEqual(0, len(mail.outbox))
+        self.assertEqual([[u.email], [u2.email]], [m.to for m in mail.outbox])
+
+    def test_batch_discarded_on_error(self):
+        u = PUser.get_by_email('test@servuno.com')
+        mail.outbox = []
+        with self.assertRaises(ValueError):
+            with notify_agent.batch():
+                notify_agent.send(None, u, 'account/email/invite_instructions')
+                raise ValueError()
+        self.assertEqual(0, len(mail.outbox))
+        # the queue is reset, so later messages are sent right away.
+        notify_agent.send(None, u, 'account/email/invite_instructions')
+        self.assertEqual(1, len(mail.outbox))
+
+    def test_send_each(self):
+        users = [PUser.get_by_email('test%s@servuno.com' % s) for s in ('1', '2', '3')]
+        mail.outbox = []
+        notify_agent.send_each(None, 'account/email/invite_instructions', [(u, {'index': i}) for i, u in enumerate(users)])
+        self.assertEqual([[u.email] for u in users], [m.to for m in mail.outbox])
+        # same output as rendering one by one.
+        single = notify_agent.render('account/email/invite_instructions', notify_agent.get_context(users[0], users[1], 'account/email/invite_instructions'))
+        self.assertEqual([single], notify_agent.render_many('account/email/invite_instructions', [notify_agent.get_context(users[0], users[1], 'account/email/invite_instructions')]))
+
+    def test_send_each_options(self):
+        u, u1, u2 = [PUser.get_by_email('test%s@servuno.com' % s) for s in ('', '1', '2')]
+        mail.outbox = []
+        notify_agent.send_each(u, 'account/email/invite_instructions', [(u1, None), (u2, None)], anonymous=True, cc_user_list=[u, 'cc@servuno.com'])
+        self.assertEqual([[u.email], [u.email]], [m.to for m in mail.outbox])
+        self.assertEqual([[u1.email], [u2.email]], [m.bcc for m in mail.outbox])
+        self.assertEqual([[u.email, 'cc@servuno.com']] * 2, [m.cc for m in mail.outbox])
+
+    def test_system_identity(self):
+        admin = notify_agent.get_site_admin_user()
+        self.assertIs(admin, notify_agent.get_site_admin_user())
+        admin.first_name = 'Admin'
+        admin.save()
+        self.assertIsNot(admin, notify_agent.get_site_admin_user())
+        self.assertEqual(admin, notify_agent.get_site_admin_user())
+
+    def test_system_identity_ttl(self):
+        admin = notify_agent.get_site_admin_user()
+        # changes made in other processes don't send signals here, but are picked up once the cached user expires.
+        PUser.objects.filter(pk=admin.pk).update(first_name='Changed')
+        with self.settings(SYSTEM_IDENTITY_TTL=0):
+            self.assertEqual('Changed', notify_agent.get_site_admin_user().first_name)